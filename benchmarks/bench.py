@@ -0,0 +1,241 @@
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+
+BENCH_DIR = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, os.pardir, "ebf"))
+
+import compiler
+import optimizer
+from interpreter import Interpreter
+
+PROGRAM_DIR = os.path.join(BENCH_DIR, "programs")
+BASELINE_FILE = os.path.join(BENCH_DIR, "baseline.json")
+# Timings only mean something against timings from the same machine, so they live in their own
+# baseline, recorded locally with --save_baseline --timings and never committed
+TIMING_BASELINE_FILE = os.path.join(BENCH_DIR, "timings.json")
+
+# Kinds of results that are timings. Every other kind is a size, which is deterministic.
+TIMED = ("compile", "interpret")
+
+# Metrics where a larger value is better. Every other metric regresses when it grows.
+HIGHER_IS_BETTER = ("ips",)
+
+def synthetic(lines):
+    # A large program touching every kind of instruction the compiler emits
+    body = ( "+++>>-[<+>-]<.,#5 +:3 >#2 &:-1 |#0x0F ^:2 ~ \\#1 /#1 <#3\n"
+             "# comment\n"
+             "[->+>+<<]>>[-<<+>>]<<[-]\n" )
+    return body * lines
+
+def addu32_chain(count):
+    # count 32-bit additions A += B, byte by byte with a ripple carry, in EBF's relative addressing.
+    # Cells 0-3 hold A and 4-7 hold B, little endian. Cell 8 is the carry, 9 the byte sum and 10-12
+    # scratch. The carry out of a + b + c is ((a & b) | ((a | b) & ~s)) >> 7.
+    setup = []
+    for cell, value in enumerate((0x78, 0x56, 0x34, 0x12, 0xEF, 0xCD, 0xAB, 0x89)):
+        setup.append( ">#{0} ,#{1} <#{0}".format(cell, value) if cell else ",#{}".format(value) )
+    add = [ ">#8 ,#0 <#8" ]
+    for byte in range(4):
+        a, b = byte, byte + 4
+        add.append( ">#9 ,#0 |:{} +:{} +:-1 <#9".format(a - 9, b - 9) )
+        add.append( ">#10 ,#0 |:{} &:{} <#10".format(a - 10, b - 10) )
+        add.append( ">#11 ,#0 |:{} |:{} <#11".format(a - 11, b - 11) )
+        add.append( ">#12 ~:-3 <#12" )
+        add.append( ">#11 &:1 <#11 >#10 |:1 /#7 <#10" )
+        add.append( ">#8 ,#0 |:2 <#8" )
+        add.append( ">#{0} ,#0 |:{1} <#{0}".format(a, 9 - a) if a else ",#0 |:9" )
+    output = ". >#1 . >#1 . >#1 . <#3"
+    return "\n".join( setup + add * count + [output] ) + "\n"
+
+def addu32_expected(count):
+    total = (0x12345678 + count * 0x89ABCDEF) & 0xFFFFFFFF
+    return "".join( chr((total >> (8 * byte)) & 0xFF) for byte in range(4) )
+
+def programs(scale=1):
+    # Benchmark programs by name: the synthetic ones plus every .b and .ebf file in programs/
+    found = { "synthetic": synthetic(2000 * scale),
+              "addu32": addu32_chain(200 * scale) }
+    for name in sorted(os.listdir(PROGRAM_DIR)):
+        if os.path.splitext(name)[1] in (".b", ".ebf"):
+            with open(os.path.join(PROGRAM_DIR, name), 'r') as f:
+                found[os.path.splitext(name)[0]] = f.read()
+    return found
+
+def best_time(function, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        function()
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+def bench_compile(results, name, source, repeat):
+    for level in range(optimizer.MAX_LEVEL + 1):
+        c = compiler.Compiler(source, optimization=level)
+        seconds = best_time(lambda: compiler.Compiler(source, optimization=level).compile(), repeat)
+        c.compile()
+        application = c.application()
+        results["compile/{}/O{}".format(name, level)] = { "seconds": seconds }
+        results["size/{}/O{}".format(name, level)] = {
+            "lines": application.count("\n"),
+            "statements": application.count(";") }
+
+class _Output(object):
+    # Collects the output of a run in memory
+    def __init__(self):
+        self.text = []
+    def write(self, text):
+        self.text.append(text)
+
+def _interpreter(source, optimize):
+    i = Interpreter.from_source(source, optimize=optimize, data_array_size=30000, cell_width=8)
+    i.stdout = _Output()
+    i.stdin = b""
+    return i
+
+def bench_interpret(results, name, source, repeat):
+    # Instructions per second count the decoded source instructions a plain stepping run executes
+    reference = _interpreter(source, False)
+    steps = 0
+    while reference.step():
+        steps += 1
+    expected = "".join(reference.stdout.text)
+
+    def run_mode(optimize, method):
+        def run():
+            i = _interpreter(source, optimize)
+            if method == "run":
+                i.run()
+            else:
+                while i.step():
+                    pass
+            i.flush()
+            if "".join(i.stdout.text) != expected:
+                raise AssertionError("{} produced different output in {} mode".format(name, method))
+        return run
+
+    for mode, optimize, method in (("step", False, "step"), ("step-fused", True, "step"), ("run", True, "run")):
+        seconds = best_time(run_mode(optimize, method), repeat)
+        results["interpret/{}/{}".format(name, mode)] = { "seconds": seconds,
+                                                          "ips": steps / seconds if seconds else 0.0 }
+    return expected
+
+def run_all(scale=1, repeat=3, only=None):
+    results = {}
+    for name, source in sorted(programs(scale).items()):
+        if only and name not in only:
+            continue
+        bench_compile(results, name, source, repeat)
+        output = bench_interpret(results, name, source, repeat)
+        if name == "addu32" and output != addu32_expected(200 * scale):
+            raise AssertionError("addu32 computed the wrong sum")
+    return results
+
+def select(results, timed):
+    # The timings, or the sizes, among results
+    return dict( (key, value) for key, value in results.items()
+                 if (key.split("/")[0] in TIMED) == timed )
+
+def compare(results, baseline, tolerance):
+    # Regressions of results against baseline as messages. Timings may be worse by tolerance
+    # (a fraction), sizes may not grow at all.
+    regressions = []
+    for key in sorted(baseline):
+        if key not in results:
+            continue
+        for metric, old in sorted(baseline[key].items()):
+            new = results[key].get(metric)
+            if new is None:
+                continue
+            allowed = tolerance if key.split("/")[0] in TIMED else 0.0
+            if metric in HIGHER_IS_BETTER:
+                worse = new < old / (1.0 + allowed)
+            else:
+                worse = new > old * (1.0 + allowed)
+            if worse:
+                regressions.append( "{} {}: {:.6g} -> {:.6g}".format(key, metric, old, new) )
+    return regressions
+
+def load_baseline(path, scale):
+    # The results in the baseline at path, or None if there is none
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r') as f:
+        baseline = json.load(f)
+    if baseline.get("scale") != scale:
+        sys.exit("The baseline {} was recorded with --scale {}.".format(path, baseline.get("scale")))
+    return baseline
+
+def main():
+    argparser = argparse.ArgumentParser( description="Benchmarks for the EBF compiler and interpreter." )
+    argparser.add_argument( "-o", "--output", default=None,
+                            help="A file to write the results to as JSON." )
+    argparser.add_argument( "--baseline", default=BASELINE_FILE,
+                            help="The sizes to compare against." )
+    argparser.add_argument( "--save_baseline", action="store_true",
+                            help="Store the results as the new baseline instead of comparing." )
+    argparser.add_argument( "--timings", action="store_true",
+                            help="Also compare timings, against a timing baseline recorded on this machine." )
+    argparser.add_argument( "--timing_baseline", default=TIMING_BASELINE_FILE,
+                            help="The timings to compare against with --timings." )
+    argparser.add_argument( "--tolerance", type=float, default=0.25,
+                            help="How much slower than the timing baseline a timing may be, as a fraction." )
+    argparser.add_argument( "--scale", type=int, default=1,
+                            help="Multiplies the size of the synthetic programs." )
+    argparser.add_argument( "--repeat", type=int, default=3,
+                            help="Timings are the best of this many runs." )
+    argparser.add_argument( "programs", nargs='*',
+                            help="Only run these benchmark programs." )
+
+    args = argparser.parse_args()
+
+    results = run_all(args.scale, args.repeat, args.programs)
+    report = { "python": platform.python_version(),
+               "platform": platform.platform(),
+               "machine": platform.node(),
+               "scale": args.scale,
+               "results": results }
+
+    for key in sorted(results):
+        print( "{:<32} {}".format(key, " ".join( "{}={:.6g}".format(metric, value)
+                                                 for metric, value in sorted(results[key].items()) )) )
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
+    if args.save_baseline:
+        # Sizes are the same everywhere, timings only on this machine
+        with open(args.baseline, 'w') as f:
+            json.dump({ "scale": args.scale, "results": select(results, False) }, f, indent=2, sort_keys=True)
+        if args.timings:
+            with open(args.timing_baseline, 'w') as f:
+                json.dump(dict(report, results=select(results, True)), f, indent=2, sort_keys=True)
+        return
+
+    regressions = []
+    baseline = load_baseline(args.baseline, args.scale)
+    if baseline is not None:
+        regressions += compare(select(results, False), baseline["results"], 0.0)
+    if args.timings:
+        timings = load_baseline(args.timing_baseline, args.scale)
+        if timings is None:
+            sys.exit("No timing baseline at {}; record one with --save_baseline --timings.".format(args.timing_baseline))
+        if timings.get("machine") != platform.node():
+            sys.exit("The timing baseline {} was recorded on {}, not on this machine.".format(
+                args.timing_baseline, timings.get("machine")))
+        regressions += compare(select(results, True), timings["results"], args.tolerance)
+    for regression in regressions:
+        print( "Regression: " + regression )
+    if regressions:
+        sys.exit("{} regressions.".format(len(regressions)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,223 @@
+import io
+import os
+import sys
+import shutil
+import random
+import argparse
+import tempfile
+import subprocess
+
+BENCH_DIR = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, os.pardir, "ebf"))
+
+import compiler
+import frontend
+import optimizer
+from interpreter import Interpreter
+
+# Instructions the random programs are built from, in the compiler's syntax
+ATOMS = ( "+", "-", ">", "<", ">", "<", "+#3", "-#2", ">#2", "<#3", ">#0", ".", ",#7", "&:1", "|:-1",
+          "^:2", "~", "/#1", "\\#1", "+:2", "-:-1", "!(f1)", "_", ".:1", "[#0 + ]", "+#1" )
+# Moves by the value of a cell, which can take the data pointer anywhere
+DYNAMIC_MOVES = ( ">:1", "<:-2" )
+# How far the atoms move the generated C's data pointer. f1 moves it too.
+MOVES = { ">": 1, "<": -1, ">#2": 2, "<#3": -3, "!(f1)": 1 }
+
+# The generated C runs between PRE and POST, which print the final data pointer and the non-zero
+# cells after the program's output. f1 is the extern the programs call.
+PRE = """#include <stdio.h>
+#include <stdint.h>
+typedef uint8_t cell_t; cell_t* DP; cell_t cells[8192];
+void f1(void){ *DP += 3; DP += 1; }
+int main(void){ cell_t* dp; int i; DP = cells+4096; dp = DP;
+"""
+POST = """DP = dp; printf("\\n%ld\\n", (long)(DP-cells));
+for(i=0;i<8192;i++) if(cells[i]) printf("%d:%d ", i, cells[i]);
+return 0; }
+"""
+
+# The interpreter starts programs this far into its data array, so they can move left
+INTERPRETER_START = 128
+
+# A subroutine called twice, in the compiler's syntax and as the interpreter's instruction strings,
+# and what both print
+CALL_SOURCE = "+#64 !start @sub +#1 . ! @start !:sub !:sub"
+CALL_INSTRUCTIONS = ["+"] * 64 + ["(!start)", "(@sub)", "+", ".", "!", "(@start)", "(!:sub)", "(!:sub)"]
+CALL_OUTPUT = "AB"
+
+# Cells the interpreter maps to a simulated device with mapped=True, starting where programs start
+MAPPED_CELLS = (INTERPRETER_START, INTERPRETER_START + 4)
+# Fused, this would read and write the device fewer times
+MAPPED_SOURCE = "+#3 ~ +#3 - +"
+
+def random_program(rng, dynamic=True):
+    # Random source with loops nested up to three deep. Most loops decrement their condition cell
+    # somewhere in the body, so many of them terminate. Without dynamic moves every loop body
+    # moves back to where it started, so the data pointer stays within a few cells of its start.
+    return " ".join( _random_parts(rng, 0, 8, ATOMS + DYNAMIC_MOVES if dynamic else ATOMS) )
+
+def _random_parts(rng, depth, length, atoms):
+    parts = []
+    for _ in range(rng.randint(1, length)):
+        r = rng.random()
+        if r < 0.2 and depth < 3:
+            kind = rng.random()
+            if kind < 0.3:
+                body = ["-"] + _random_parts(rng, depth + 1, 5, atoms)
+            elif kind < 0.6:
+                body = _random_parts(rng, depth + 1, 4, atoms) + ["-"]
+            else:
+                body = [">"] + _random_parts(rng, depth + 1, 3, atoms) + ["<", "-"]
+            # Nested loops are balanced already, so only the body's own moves count
+            offset = sum( MOVES.get(part, 0) for part in body )
+            if offset:
+                body.append( "<#{}".format(offset) if offset > 0 else ">#{}".format(-offset) )
+            parts += ["["] + body + ["]"]
+        elif r < 0.25:
+            parts.append("[-]")
+        else:
+            parts.append(rng.choice(atoms))
+    return parts
+
+def run_c(source, level, work_dir, cflags, timeout):
+    # Output of source compiled at level and built with gcc, or None if it did not finish in time
+    name = os.path.join(work_dir, "O{}".format(level))
+    with open(name + ".c", 'w') as f:
+        f.write( PRE + compiler.Compiler(source, optimization=level).compile() + POST )
+    subprocess.run( ["gcc", "-w"] + cflags.split() + ["-o", name, name + ".c"], check=True )
+    try:
+        return subprocess.run( [name], capture_output=True, timeout=timeout ).stdout
+    except subprocess.TimeoutExpired:
+        return None
+
+def check_compiler(rng, count, cflags, timeout):
+    # Compares the C the compiler generates at each optimization level against -O0. Programs
+    # that do not finish at every level are skipped.
+    mismatches = []
+    checked = 0
+    with tempfile.TemporaryDirectory() as work_dir:
+        for _ in range(count):
+            source = random_program(rng, dynamic=False)
+            expected = run_c(source, 0, work_dir, cflags, timeout)
+            if expected is None:
+                continue
+            outputs = [ run_c(source, level, work_dir, cflags, timeout) for level in range(1, optimizer.MAX_LEVEL + 1) ]
+            # A level that did not finish in time says nothing about the program
+            if None in outputs:
+                continue
+            for level, output in enumerate(outputs, 1):
+                if output != expected:
+                    mismatches.append( "-O{}: {}".format(level, source) )
+            checked += 1
+    return checked, mismatches
+
+def _f1(interpreter):
+    # The interpreter's f1 only adds 3 to the current cell
+    data, dp = interpreter.data_array, interpreter.data_pointer
+    data[dp] = (data[dp] + 3) & 0xFF
+
+def run_interpreter(source, optimize, method, step_limit, mapped=False):
+    # Final state of source run by stepping or through run(), None if stepping hit step_limit, or
+    # the name of the error the program raised. With mapped, the state includes every access to
+    # the mapped cells in order.
+    i = Interpreter.from_source(">#{} ".format(INTERPRETER_START) + source, optimize=optimize,
+                                data_array_size=2 * INTERPRETER_START, cell_width=8)
+    i.functions["f1"] = _f1
+    if not mapped:
+        return _finish(i, method, step_limit)
+    accesses = []
+    def read(address):
+        accesses.append( (address,) )
+        return (address * 7 + 3) & 0xFF
+    def write(address, value):
+        accesses.append( (address, value) )
+    i.map_io( MAPPED_CELLS[0], MAPPED_CELLS[1], read, write )
+    result = _finish(i, method, step_limit)
+    return result + (accesses,) if isinstance(result, tuple) else result
+
+def _finish(i, method, step_limit):
+    i.stdout = io.StringIO()
+    i.stdin = b"ebf"
+    try:
+        if method == "run":
+            i.run()
+        else:
+            steps = 0
+            while i.step():
+                steps += 1
+                if steps > step_limit:
+                    return None
+    except Exception as e:
+        return type(e).__name__
+    i.flush()
+    return i.stdout.getvalue(), bytes(i.data_array), i.data_pointer
+
+def check_interpreter(rng, count, step_limit, mapped=False):
+    # Compares stepping the fused program and run() against stepping the program as decoded. With
+    # mapped, a device must also see the same reads and writes in every mode.
+    sources = [ random_program(rng) for _ in range(count) ]
+    if mapped:
+        sources.insert( 0, MAPPED_SOURCE )
+    mismatches = []
+    checked = 0
+    for source in sources:
+        expected = run_interpreter(source, False, "step", step_limit, mapped)
+        if expected is None or isinstance(expected, str):
+            continue
+        for mode, optimize, method in (("step-fused", True, "step"), ("run", True, "run")):
+            if run_interpreter(source, optimize, method, step_limit, mapped) != expected:
+                mismatches.append( "{}{}: {}".format(mode, " mapped" if mapped else "", source) )
+        checked += 1
+    return checked, mismatches
+
+def check_calls(step_limit):
+    # Runs a call and return in both syntaxes the interpreter reads, in every mode
+    mismatches = []
+    for syntax, app in (("source", frontend.parse(CALL_SOURCE)),
+                        ("instructions", frontend.Application(None, CALL_INSTRUCTIONS))):
+        for mode, optimize, method in (("step", False, "step"), ("step-fused", True, "step"), ("run", True, "run")):
+            result = _finish(Interpreter(app, optimize=optimize), method, step_limit)
+            if not isinstance(result, tuple) or result[0] != CALL_OUTPUT:
+                mismatches.append( "calls {} {}: {!r}".format(syntax, mode, result) )
+    return mismatches
+
+def main():
+    argparser = argparse.ArgumentParser( description="Checks that the EBF optimization levels and interpreter modes agree on random programs." )
+    argparser.add_argument( "--seed", type=int, default=0,
+                            help="Seed for the random programs." )
+    argparser.add_argument( "--count", type=int, default=100,
+                            help="How many random programs each check runs." )
+    argparser.add_argument( "--cflags", default="-O0",
+                            help="Options for gcc when building the generated C." )
+    argparser.add_argument( "--timeout", type=float, default=2.0,
+                            help="Seconds a built program may run before it is skipped." )
+    argparser.add_argument( "--step_limit", type=int, default=20000,
+                            help="Steps an interpreted program may take before it is skipped." )
+
+    args = argparser.parse_args()
+
+    mismatches = []
+    if shutil.which("gcc") is None:
+        print( "Skipping the compiler check, gcc was not found." )
+    else:
+        checked, found = check_compiler(random.Random(args.seed), args.count, args.cflags, args.timeout)
+        print( "compiler: {} programs, {} mismatches".format(checked, len(found)) )
+        mismatches += found
+    checked, found = check_interpreter(random.Random(args.seed), args.count, args.step_limit)
+    print( "interpreter: {} programs, {} mismatches".format(checked, len(found)) )
+    mismatches += found
+    checked, found = check_interpreter(random.Random(args.seed), args.count, args.step_limit, mapped=True)
+    print( "interpreter with mapped cells: {} programs, {} mismatches".format(checked, len(found)) )
+    mismatches += found
+    found = check_calls(args.step_limit)
+    print( "calls: {} mismatches".format(len(found)) )
+    mismatches += found
+
+    for mismatch in mismatches:
+        print( "Mismatch " + mismatch )
+    if mismatches:
+        sys.exit("{} mismatches.".format(len(mismatches)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,4 @@
+# Nested counting loops running the innermost loop 8 times 8 times 8 times 4 times
+# then a hello world that prints "Hello#World$", as the cells it starts from are not zero
+++++++++[>++++++++[>++++++++[>++++[>+>++>+++<<<-]>[-]>>[-]<<<<-]<-]<-]>>>>>+++[>]<<<<<<[<]
+++++++++[>++++[>++>+++>+++>+<<<<-]>+>+>->>+[<]<-]>>.>---.+++++++..+++.>>.<-.<.+++.------.--------.>>+.>++.
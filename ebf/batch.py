@@ -0,0 +1,360 @@
+import numpy
+import frontend
+from interpreter import ( Interpreter, config_options, OP_RIGHT, OP_LEFT, OP_INC, OP_DEC, OP_OUTPUT,
+                          OP_INPUT, OP_OPEN, OP_CLOSE, OP_NOT, OP_SWAP_DP, OP_SWAP_IP, OP_AND, OP_OR,
+                          OP_XOR, OP_RSHIFT, OP_LSHIFT, OP_JUMP, OP_CALL, OP_ADD, OP_MOVE, OP_CLEAR,
+                          OP_SCAN, OP_MULTIPLY, OP_NOP, OP_LABEL, OP_EXTERN, OP_COUNT, MODE_NONE,
+                          MODE_AT, MODE_AT_ABS, MODE_AT_REL, MODE_AT_REL_ABS, MODE_LIT, MODE_LIT_ABS,
+                          MODE_LIT_REL, MODE_LIT_REL_ABS, MODE_COND_LIT, MODE_MOVE_REL, MODE_COUNT )
+
+# NumPy type of the cells for each cell width
+_CELL_DTYPES = { 8: numpy.uint8, 16: numpy.uint16, 32: numpy.uint32, 64: numpy.uint64 }
+
+# Instructions that move the instruction pointer other than through brackets. Lanes cannot follow
+# them independently, so programs using them are not supported.
+_UNSTRUCTURED_OPCODES = ( OP_SWAP_IP, OP_JUMP, OP_CALL, OP_EXTERN )
+
+
+def _wide(value):
+    # value as unsigned 64 bit integers, so that arithmetic wraps the same as on Python ints masked
+    # to the cell width
+    return numpy.asarray( value ).astype( numpy.uint64 )
+
+def _shift(value, count, left):
+    # value shifted by count bits, zero for counts of 64 or more like Python ints masked to 64 bits
+    value = _wide( value )
+    count = _wide( count )
+    bounded = numpy.minimum( count, numpy.uint64(63) )
+    shifted = numpy.left_shift( value, bounded ) if left else numpy.right_shift( value, bounded )
+    return numpy.where( count > 63, numpy.uint64(0), shifted )
+
+
+class BatchInterpreter(object):
+    # Runs one program over many independent data arrays in lockstep. Memory is a (lanes, cells)
+    # array and every lane has its own data pointer, shadow data pointer, input and output. All
+    # lanes share the instruction pointer: a loop runs while any lane is still in it, and the
+    # lanes that have left it are masked off until the rest follow.
+
+    def __init__(self, app, lanes, data_array_size=1024, optimize=True, cell_width=8, eof=-1):
+        if cell_width not in _CELL_DTYPES:
+            raise ValueError( "Unknown cell width: {}".format(cell_width) )
+        self._app = app
+        self._lanes = lanes
+        self._data_array_size = data_array_size
+        self._cell_width = cell_width
+        self._cell_mask = (1 << cell_width) - 1
+        self._dtype = _CELL_DTYPES[cell_width]
+        self._eof = eof
+
+        self._program = Interpreter.decode( app.instructions )
+        if optimize:
+            self._program, _ = Interpreter.fuse( self._program )
+        for index, (opcode, mode, operand) in enumerate(self._program):
+            if opcode in _UNSTRUCTURED_OPCODES:
+                raise ValueError( "Batches only run structured control flow: {}".format(index) )
+        self._jump_table = Interpreter.match_brackets( self._program )
+        self._dispatch = self._build_dispatch()
+
+        self._input = numpy.zeros( (lanes, 0), dtype=numpy.uint8 )
+        self._input_length = numpy.zeros( lanes, dtype=numpy.int64 )
+        self.reset()
+
+    @classmethod
+    def from_source(cls, source, lanes, cache_dir=None, **kwargs):
+        # BatchInterpreter for EBF source in the compiler's syntax, like Interpreter.from_source()
+        app = frontend.load( source, cache_dir )
+        return cls( app, lanes, **config_options(app, kwargs) )
+
+    def lanes():
+        doc = "The number of lanes."
+        def fget(self):
+            return self._lanes
+        return locals()
+    lanes = property(**lanes())
+
+    def memory():
+        doc = "The data arrays as a (lanes, cells) array. Setting it copies the given values in."
+        def fget(self):
+            return self._memory
+        def fset(self, value):
+            self._memory[...] = value
+        return locals()
+    memory = property(**memory())
+
+    def data_pointers():
+        doc = "The data pointer of each lane."
+        def fget(self):
+            return self._data_pointer
+        return locals()
+    data_pointers = property(**data_pointers())
+
+    def shadow_data_pointers():
+        doc = "The shadow data pointer of each lane."
+        def fget(self):
+            return self._shadow_data_pointer
+        return locals()
+    shadow_data_pointers = property(**shadow_data_pointers())
+
+    def stdin():
+        doc = "The input of each lane, as a sequence of bytes objects or a (lanes, length) array."
+        def fget(self):
+            return self._input
+        def fset(self, value):
+            if isinstance(value, numpy.ndarray):
+                self._input = value.reshape( (self._lanes, -1) )
+                self._input_length = numpy.full( self._lanes, self._input.shape[1], dtype=numpy.int64 )
+            else:
+                if len(value) != self._lanes:
+                    raise ValueError( "Expected input for {} lanes, got {}".format(self._lanes, len(value)) )
+                self._input_length = numpy.array( [ len(data) for data in value ], dtype=numpy.int64 )
+                self._input = numpy.zeros( (self._lanes, max(self._input_length.max(initial=0), 1)), dtype=numpy.uint8 )
+                for lane, data in enumerate(value):
+                    self._input[lane, :len(data)] = numpy.frombuffer( bytes(data), dtype=numpy.uint8 )
+            self._input_position = numpy.zeros( self._lanes, dtype=numpy.int64 )
+        return locals()
+    stdin = property(**stdin())
+
+    def reset(self):
+        # Zero every lane's data array and pointers and rewind the input. Output is discarded.
+        self._memory = numpy.zeros( (self._lanes, self._data_array_size), dtype=self._dtype )
+        self._data_pointer = numpy.zeros( self._lanes, dtype=numpy.int64 )
+        self._shadow_data_pointer = numpy.zeros( self._lanes, dtype=numpy.int64 )
+        self._input_position = numpy.zeros( self._lanes, dtype=numpy.int64 )
+        self._instruction_pointer = 0
+        self._outputs = []
+        # Masks of the lanes running each enclosing loop, innermost last
+        self._masks = []
+        self._set_active( numpy.ones( self._lanes, dtype=bool ) )
+
+    def _set_active(self, mask):
+        self._active = mask
+        self._rows = numpy.nonzero( mask )[0]
+
+    def outputs(self):
+        # Everything each lane has output so far, as a list of bytes objects
+        if not self._outputs:
+            return [ b'' ] * self._lanes
+        rows = numpy.concatenate( [ rows for rows, values in self._outputs ] )
+        values = numpy.concatenate( [ values for rows, values in self._outputs ] )
+        # A stable sort groups the output by lane and keeps each lane's output in order
+        order = numpy.argsort( rows, kind="stable" )
+        values = values[order]
+        ends = numpy.cumsum( numpy.bincount( rows, minlength=self._lanes ) )
+        starts = ends - numpy.bincount( rows, minlength=self._lanes )
+        return [ values[start:end].tobytes() for start, end in zip(starts, ends) ]
+
+    def step(self):
+        # run the current instruction for every active lane and step the program
+        if self._instruction_pointer >= len(self._program):
+            return False
+        opcode, mode, operand = self._program[self._instruction_pointer]
+        self._dispatch[opcode][mode]( operand )
+        self._instruction_pointer += 1
+        return True
+
+    def run(self):
+        # Run the program to completion in every lane
+        while self.step():
+            pass
+
+    def _value(self, operand):
+        # The operand for the active lanes: the shadow data pointer when None
+        if operand is None:
+            return self._shadow_data_pointer[self._rows]
+        return operand
+
+    def _cells(self, addresses):
+        # Cells at addresses of the active lanes, as indexes
+        return self._memory[self._rows, addresses].astype( numpy.int64 )
+
+    def _store(self, addresses, values):
+        # Write values masked to the cell width to addresses of the active lanes
+        self._memory[self._rows, addresses] = ( _wide(values) & numpy.uint64(self._cell_mask) ).astype( self._dtype )
+
+    def _read_input(self):
+        # Next input value of each active lane, or eof for lanes at the end of their input
+        rows = self._rows
+        position = self._input_position[rows]
+        available = position < self._input_length[rows]
+        if self._eof is None and not available.all():
+            raise EOFError( "End of input: {}".format(self._instruction_pointer) )
+        if self._input.shape[1] == 0:
+            values = numpy.zeros( len(rows), dtype=numpy.uint64 )
+        else:
+            values = _wide( self._input[rows, numpy.minimum(position, self._input.shape[1] - 1)] )
+        eof = numpy.uint64( (self._eof or 0) & self._cell_mask )
+        self._input_position[rows] = position + available
+        return numpy.where( available, values, eof )
+
+    def _put(self, values):
+        # Output the low byte of each active lane's value
+        values = ( _wide(values) & numpy.uint64(0xFF) ).astype( numpy.uint8 )
+        self._outputs.append( (self._rows.copy(), numpy.broadcast_to(values, self._rows.shape).copy()) )
+
+    def _build_dispatch(self):
+        # Build the dispatch table indexed by [opcode][mode], like Interpreter._build_dispatch().
+        # Handlers act on the active lanes, self._rows.
+        dispatch = [ [None] * MODE_COUNT for _ in range(OP_COUNT) ]
+
+        # '@' modes resolve a target cell, '#' modes resolve a source value
+        address = { MODE_AT:         lambda value: value,
+                    MODE_AT_ABS:     lambda value: self._cells( value ),
+                    MODE_AT_REL:     lambda value: self._data_pointer[self._rows] + value,
+                    MODE_AT_REL_ABS: lambda value: self._cells( self._data_pointer[self._rows] + value ) }
+        source = { MODE_LIT:         lambda value: value,
+                   MODE_LIT_ABS:     lambda value: self._cells( value ),
+                   MODE_LIT_REL:     lambda value: self._cells( self._data_pointer[self._rows] + value ),
+                   MODE_LIT_REL_ABS: lambda value: self._cells( self._cells( self._data_pointer[self._rows] + value ) ) }
+
+        # New value of a cell from its old value and the current cell or operand value
+        operations = { OP_INC: lambda old, value: _wide(old) + _wide(value),
+                       OP_DEC: lambda old, value: _wide(old) - _wide(value),
+                       OP_AND: lambda old, value: _wide(old) & _wide(value),
+                       OP_OR: lambda old, value: _wide(old) | _wide(value),
+                       OP_XOR: lambda old, value: _wide(old) ^ _wide(value),
+                       OP_RSHIFT: lambda old, value: _shift(old, value, False),
+                       OP_LSHIFT: lambda old, value: _shift(old, value, True) }
+
+        dispatch[OP_RIGHT][MODE_NONE] = lambda value: self._move_dp( 1 )
+        dispatch[OP_LEFT][MODE_NONE] = lambda value: self._move_dp( -1 )
+        dispatch[OP_MOVE][MODE_NONE] = self._move_dp
+        dispatch[OP_INC][MODE_NONE] = lambda value: self._update( operations[OP_INC], 1 )
+        dispatch[OP_DEC][MODE_NONE] = lambda value: self._update( operations[OP_DEC], 1 )
+        dispatch[OP_ADD][MODE_NONE] = lambda value: self._update( operations[OP_INC], value )
+        dispatch[OP_OUTPUT][MODE_NONE] = lambda value: self._put( self._current() )
+        dispatch[OP_INPUT][MODE_NONE] = lambda value: self._store( self._data_pointer[self._rows], self._read_input() )
+        dispatch[OP_NOT][MODE_NONE] = lambda value: self._store( self._data_pointer[self._rows], ~_wide(self._current()) )
+        dispatch[OP_CLEAR][MODE_NONE] = lambda value: self._store( self._data_pointer[self._rows], 0 )
+        dispatch[OP_SWAP_DP][MODE_NONE] = self._swap_dp
+        dispatch[OP_SCAN][MODE_NONE] = self._scan
+        dispatch[OP_MULTIPLY][MODE_NONE] = self._multiply
+        dispatch[OP_NOP][MODE_NONE] = self._nop
+        dispatch[OP_LABEL][MODE_NONE] = self._nop
+        dispatch[OP_RIGHT][MODE_MOVE_REL] = lambda value: self._add_dp( self._cells(self._data_pointer[self._rows] + value) )
+        dispatch[OP_LEFT][MODE_MOVE_REL] = lambda value: self._add_dp( -self._cells(self._data_pointer[self._rows] + value) )
+
+        # Brackets jump when the condition holds for every active lane, and otherwise run the
+        # loop for the lanes where it does not
+        dispatch[OP_OPEN][MODE_NONE] = lambda value: self._open( self._current() == 0 )
+        dispatch[OP_CLOSE][MODE_NONE] = lambda value: self._close( self._current() != 0 )
+        dispatch[OP_OPEN][MODE_COND_LIT] = lambda value: self._open( numpy.broadcast_to(self._value(value) == 0, self._rows.shape) )
+        dispatch[OP_CLOSE][MODE_COND_LIT] = lambda value: self._close( numpy.broadcast_to(self._value(value) != 0, self._rows.shape) )
+
+        # Data pointer moves: '@' and '#' are interchangeable, ':' is relative and '*' reads the
+        # amount from the cell at the operand.
+        for base in (MODE_AT, MODE_LIT):
+            for opcode, sign in ((OP_RIGHT, 1), (OP_LEFT, -1)):
+                dispatch[opcode][base] = lambda value: self._set_dp( self._value(value) )
+                dispatch[opcode][base + 1] = lambda value: self._set_dp( self._cells(self._value(value)) )
+                dispatch[opcode][base + 2] = lambda value, sign=sign: self._add_dp( sign * numpy.asarray(self._value(value)) )
+                dispatch[opcode][base + 3] = lambda value, sign=sign: self._add_dp( sign * self._cells(self._value(value)) )
+
+        for mode, resolve in address.items():
+            def target(value, resolve=resolve):
+                return resolve( self._value(value) )
+            for opcode, operation in operations.items():
+                dispatch[opcode][mode] = lambda value, target=target, operation=operation: \
+                    self._store_at( target(value), operation, self._current() )
+            dispatch[OP_INC][mode] = lambda value, target=target: self._store_at( target(value), operations[OP_INC], 1 )
+            dispatch[OP_DEC][mode] = lambda value, target=target: self._store_at( target(value), operations[OP_DEC], 1 )
+            dispatch[OP_OUTPUT][mode] = lambda value, target=target: self._store( target(value), self._current() )
+            dispatch[OP_INPUT][mode] = lambda value, target=target: self._store( target(value), self._read_input() )
+            dispatch[OP_OPEN][mode] = lambda value, target=target: self._open( self._memory[self._rows, target(value)] == 0 )
+            dispatch[OP_CLOSE][mode] = lambda value, target=target: self._close( self._memory[self._rows, target(value)] != 0 )
+
+        for mode, resolve in source.items():
+            def operand(value, resolve=resolve):
+                return resolve( self._value(value) )
+            for opcode, operation in operations.items():
+                dispatch[opcode][mode] = lambda value, operand=operand, operation=operation: \
+                    self._update( operation, operand(value) )
+            dispatch[OP_OUTPUT][mode] = lambda value, operand=operand: self._put( operand(value) )
+            dispatch[OP_INPUT][mode] = lambda value, operand=operand: self._store( self._data_pointer[self._rows], operand(value) )
+            dispatch[OP_NOT][mode] = lambda value, operand=operand: self._store( self._data_pointer[self._rows], ~_wide(operand(value)) )
+            dispatch[OP_OPEN][mode] = lambda value, operand=operand: self._open( _wide(self._current()) == _wide(operand(value)) )
+            dispatch[OP_CLOSE][mode] = lambda value, operand=operand: self._close( _wide(self._current()) != _wide(operand(value)) )
+
+        return dispatch
+
+    def _current(self):
+        # The current cell of each active lane
+        return self._memory[self._rows, self._data_pointer[self._rows]]
+
+    def _update(self, operation, value):
+        # Write operation(current cell, value) to the current cell of each active lane
+        addresses = self._data_pointer[self._rows]
+        self._store( addresses, operation(self._memory[self._rows, addresses], value) )
+
+    def _store_at(self, addresses, operation, value):
+        # Write operation(cell, value) to the addressed cell of each active lane
+        self._store( addresses, operation(self._memory[self._rows, addresses], value) )
+
+    def _open(self, skip):
+        # '[': skip is where the loop is not entered. Lanes entering it become the active lanes
+        # until its ']'.
+        if skip.all():
+            self._instruction_pointer = self._jump_table[self._instruction_pointer]
+            return
+        self._masks.append( self._active )
+        entering = numpy.zeros( self._lanes, dtype=bool )
+        entering[self._rows[~skip]] = True
+        self._set_active( entering )
+
+    def _close(self, repeat):
+        # ']': repeat is where the loop runs again. Once no lane repeats, the lanes that were
+        # active at the '[' are active again.
+        if repeat.any():
+            if not repeat.all():
+                repeating = numpy.zeros( self._lanes, dtype=bool )
+                repeating[self._rows[repeat]] = True
+                self._set_active( repeating )
+            self._instruction_pointer = self._jump_table[self._instruction_pointer]
+        else:
+            self._set_active( self._masks.pop() )
+
+    def _move_dp(self, count):
+        # Move the data pointer by count, wrapping around the data array
+        rows = self._rows
+        self._data_pointer[rows] = (self._data_pointer[rows] + count) % self._data_array_size
+
+    def _set_dp(self, value):
+        self._data_pointer[self._rows] = value
+
+    def _add_dp(self, value):
+        self._data_pointer[self._rows] += value
+
+    def _swap_dp(self, value):
+        rows = self._rows
+        temp = self._data_pointer[rows]
+        self._data_pointer[rows] = self._shadow_data_pointer[rows]
+        self._shadow_data_pointer[rows] = temp
+
+    def _scan(self, stride):
+        # Move the data pointer of each active lane by stride until it lands on a zero cell
+        rows = self._rows
+        moving = self._memory[rows, self._data_pointer[rows]] != 0
+        for _ in range(self._data_array_size):
+            if not moving.any():
+                return
+            rows = rows[moving]
+            self._data_pointer[rows] = (self._data_pointer[rows] + stride) % self._data_array_size
+            moving = self._memory[rows, self._data_pointer[rows]] != 0
+        if moving.any():
+            raise RuntimeError( "Scan loop never finds a zero cell: {}".format(self._instruction_pointer) )
+
+    def _multiply(self, terms):
+        # Lanes with a zero current cell are left as they are, like the loop never running
+        rows = self._rows[self._current() != 0]
+        if not len(rows):
+            return
+        pointer = self._data_pointer[rows]
+        value = _wide( self._memory[rows, pointer] )
+        for offset, factor in terms:
+            target = (pointer + offset) % self._data_array_size
+            self._memory[rows, target] = ( (_wide(self._memory[rows, target]) + value * _wide(factor)) &
+                                           numpy.uint64(self._cell_mask) ).astype( self._dtype )
+        self._memory[rows, pointer] = 0
+        self._data_pointer[rows] = pointer % self._data_array_size
+
+    def _nop(self, value):
+        pass
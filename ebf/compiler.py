@@ -1,15 +1,44 @@
 import re
-import datetime
-import yaml
+import frontend
+import optimizer
+from frontend import SyntaxError, c_int
 
-class SyntaxError(Exception):
-    def __init__(self, message):
-        self.message = message
+# Bumped whenever the emitted C changes, so incremental builds regenerate their outputs
+VERSION = "0.3.0"
+
+# Instructions that start a new basic block in instrumented builds, with the block kind
+_BLOCK_KINDS = { '[': "loop", ']': "after-loop", '@': "label" }
+
+# Label names, which must also be valid C labels
+_LABEL = re.compile( r"[a-zA-Z]\w*$" )
+
+# Optimization level from which the data pointer offset is tracked at compile time
+TRACK_OFFSET_LEVEL = 3
+
+def _static_move(i):
+    # Constant amount instruction i moves the data pointer by, 0 if it does not move it, or None
+    # if the amount or the next instruction to run is only known at run time
+    if i.op in ('@', '!'):
+        return None
+    if i.op not in ('>', '<'):
+        return 0
+    if i.mode == '' and i.operand == '':
+        amount = 1
+    elif i.mode == '#' and i.operand != '':
+        amount = c_int(i.operand)
+    else:
+        return None
+    return amount if i.op == '>' else -amount
 
 class Compiler(object):
 
-    def __init__(self, ebf):
+    def __init__(self, ebf, optimization=0, cache_dir=None, instrument=False):
         self._working = ebf
+        self._optimization = optimization
+        self._cache_dir = cache_dir
+        self._instrument = instrument
+        self._counters = []
+        self._offset = 0
         self._config = {"cell_width": 16,
                         "includes": None,
                         "init_hook": False,
@@ -22,211 +51,322 @@ class Compiler(object):
     def application(self):
         return self._application
 
-    def _preprocess(self):
-        # Read configuration blocks
-        config_match = re.findall( "^\#\%\((.*?)\)", self._working, flags=re.DOTALL+re.MULTILINE )
+    def counters(self):
+        # Source location of each block counter as (line, column, kind) when instrumenting
+        return self._counters
+
+    def counter_map(self):
+        # Sidecar text mapping each counter index to its source location
+        lines = [ "# counter line:column kind" ]
+        for index, (line, column, kind) in enumerate(self._counters):
+            lines.append( "{} {}:{} {}".format(index, line, column, kind) )
+        return "\n".join(lines) + "\n"
+
+    def _parse(self):
+        app = frontend.load( self._working, self._cache_dir )
+        if app.config is not None:
+            self._config = app.config
+        return app.instructions
+
+    def _option(self, name):
+        # A config option, or None if the config block does not set it
+        if not isinstance(self._config, dict):
+            return None
+        return self._config.get(name)
+
+    def _buffered_output(self):
+        # Output goes through the buffer in main.c if it has a size or a flush hook
+        return bool(self._option("output_buffer")) or self._option("output_flush_hook") == True
+
+    def _buffered_input(self):
+        # Input goes through ebf_getchar() in main.c if it is buffered or has an EOF value
+        return ( bool(self._option("input_buffer")) or self._option("input_fill_hook") == True or
+                 self._option("input_eof") is not None )
 
-        # Only one config block per application allowed
-        if len(config_match) > 1:
-            raise SyntaxError("Multiple config blocks.")
+    def _count(self, output, i, kind):
+        # Start a new counted block at instruction i
+        output.append( "ebf_counters[" + str(len(self._counters)) + "]++;\n" )
+        self._counters.append( (i.line, i.column, kind) )
 
-        self._config = yaml.load(config_match[0])
+    def _cell(self, operand=0):
+        # C expression for the cell operand cells from the data pointer. While the offset of the
+        # data pointer is tracked, cells are indexed from dp by their static offset.
+        if self._optimization >= TRACK_OFFSET_LEVEL:
+            if not isinstance(operand, int):
+                operand = c_int(operand)
+            return "dp[" + str(self._offset + operand) + "]"
+        if operand == 0:
+            return "*dp"
+        return "*(dp + " + str(operand) + ")"
 
-        # Remove configuration blocks
-        self._working = re.sub( "^\#\%\(.*?\)", '', self._working, flags=re.DOTALL+re.MULTILINE )
-        # Remove comment lines
-        self._working = re.sub( "^\#.*", '', self._working, flags=re.MULTILINE )
-        # Condense to a single line
-        self._working = self._working.replace('\n', '').replace('\r', '')
+    def _commit(self, output):
+        # Apply the data pointer movement tracked since the last commit
+        if self._offset > 0:
+            output.append( "dp += " + str(self._offset) + ";\n" )
+        elif self._offset < 0:
+            output.append( "dp -= " + str(-self._offset) + ";\n" )
+        self._offset = 0
+
+    @staticmethod
+    def _balanced_loops(instructions):
+        # Indexes of the '[' whose loops only move the data pointer by constants that add up to
+        # zero, so the offset at the start of each iteration is known at compile time
+        balanced = set()
+        loops = []
+        for index, i in enumerate(instructions):
+            if i.op == '[':
+                loops.append( [index, 0, True] )
+            elif i.op == ']' and loops:
+                start, net, static = loops.pop()
+                if static and net == 0:
+                    balanced.add( start )
+                elif loops:
+                    loops[-1][2] = False
+            elif loops:
+                move = _static_move(i)
+                if move is None:
+                    # Jumps may leave any enclosing loop
+                    for loop in loops:
+                        loop[2] = False
+                else:
+                    loops[-1][1] += move
+        return balanced
+
+    def _error(self, i, message="Syntax error"):
+        return SyntaxError( "{}: {}".format(message, i.op + i.mode + str(i.operand) + i.label), i.line, i.column )
 
     def compile(self):
-        self._preprocess()
-        pattern = re.compile("([\_\>\<\+\-\[\]\.\,\|\&\^\~\\\/\@\!])([\:\#])?(0[xX][a-fA-F0-9]+|\-?[0-9]+)?(\(?\w+\)?)?")
-        instructions = pattern.findall( self._working )
+        instructions = optimizer.optimize( self._parse(), self._optimization )
+        output = []
+        putchar = "ebf_putchar" if self._buffered_output() else "putchar"
+        getchar = "ebf_getchar" if self._buffered_output() or self._buffered_input() else "getchar"
 
+        # Jumps may precede the label they go to, so labels are collected up front
+        labels = set()
         for i in instructions:
-            if i[0] == '_':
-                if i[1] == '' and i[2] == '':
-                    self._application += "__asm__ volatile (\"nop\");\n"
-                else:
-                    print(i)
-                    raise SyntaxError("Syntax error")
-            elif i[0] == '>':
-                if i[1] == '' and i[2] == '':
-                    self._application += "DP += 1;\n"
-                elif i[1] == '' and i[2] != '':
-                    self._application += "DP += *((cell_t*)" + str(i[2]) + ");\n"
-                elif i[1] == ':' and i[2] != '':
-                    self._application += "DP += *(DP + " + str(i[2]) + ");\n"
-                elif i[1] == '#' and i[2] != '':
-                    self._application += "DP += " + str(i[2]) + ";\n"
-                else:
-                    print(i)
-                    raise SyntaxError("Syntax error")
-            elif i[0] == '<':
-                if i[1] == '' and i[2] == '':
-                    self._application += "DP -= 1;\n"
-                elif i[1] == '' and i[2] != '':
-                    self._application += "DP -= *((cell_t*)" + str(i[2]) + ");\n"
-                elif i[1] == ':' and i[2] != '':
-                    self._application += "DP -= *(DP + " + str(i[2]) + ");\n"
-                elif i[1] == '#' and i[2] != '':
-                    self._application += "DP -= " + str(i[2]) + ";\n"
-                else:
-                    print(i)
-                    raise SyntaxError("Syntax error")
-            elif i[0] == '+':
-                if i[1] == '' and i[2] == '':
-                    self._application += "*DP += 1;\n"
-                elif i[1] == '' and i[2] != '':
-                    self._application += "*DP += *((cell_t*)" + str(i[2]) + ");\n"
-                elif i[1] == ':' and i[2] != '':
-                    self._application += "*DP += *(DP + " + str(i[2]) + ");\n"
-                elif i[1] == '#' and i[2] != '':
-                    self._application += "*DP += " + str(i[2]) + ";\n"
-                else:
-                    print(i)
-                    raise SyntaxError("Syntax error")
-            elif i[0] == '-':
-                if i[1] == '' and i[2] == '':
-                    self._application += "*DP -= 1;\n"
-                elif i[1] == '' and i[2] != '':
-                    self._application += "*DP -= *((cell_t*)" + str(i[2]) + ");\n"
-                elif i[1] == ':' and i[2] != '':
-                    self._application += "*DP -= *(DP + " + str(i[2]) + ");\n"
-                elif i[1] == '#' and i[2] != '':
-                    self._application += "*DP -= " + str(i[2]) + ";\n"
-                else:
-                    print(i)
-                    raise SyntaxError("Syntax error")
-            elif i[0] == '[':
-                if i[1] == '' and i[2] == '':
-                    self._application += "while(*DP!=0) {\n"
-                elif i[1] == '' and i[2] != '':
-                    self._application += "while(*((cell_t*)" + str(i[2]) + ")!=0) {\n"
-                elif i[1] == ':' and i[2] != '':
-                    self._application += "while(*(DP + " + str(i[2]) + ")!=0) {\n"
-                elif i[1] == '#' and i[2] != '':
-                    self._application += "while(" + str(i[2]) + "!=0) {\n"
-                else:
-                    print(i)
-                    raise SyntaxError("Syntax error")
-            elif i[0] == ']':
-                if i[1] == '' and i[2] == '':
-                    self._application += "}\n"
-                else:
-                    print(i)
-                    raise SyntaxError("Syntax error")
-            elif i[0] == '.':
-                if i[1] == '' and i[2] == '':
-                    self._application += "putchar(*DP);\n"
-                elif i[1] == '' and i[2] != '':
-                    self._application += "putchar(*((cell_t*)" + str(i[2]) + "));\n"
-                elif i[1] == ':' and i[2] != '':
-                    self._application += "putchar(*(DP + " + str(i[2]) + "));\n"
-                elif i[1] == '#' and i[2] != '':
-                    self._application += "putchar(" + str(i[2]) + ");\n"
-                else:
-                    print(i)
-                    raise SyntaxError("Syntax error")
-            elif i[0] == ',':
-                if i[1] == '' and i[2] == '':
-                    self._application += "*DP=getchar();\n"
-                elif i[1] == '' and i[2] != '':
-                    self._application += "*((cell_t*)" + str(i[2]) + ")=getchar();\n"
-                elif i[1] == ':' and i[2] != '':
-                    self._application += "*(DP + " + str(i[2]) + ")=getchar();\n"
-                elif i[1] == '#' and i[2] != '':
-                    self._application += "*DP=" + str(i[2]) + ";\n"
-                else:
-                    print(i)
-                    raise SyntaxError("Syntax error")
-            elif i[0] == '&':
-                if i[1] == '' and i[2] == '':
-                    self._application += "*DP &= *(DP+1);\n"
-                elif i[1] == '' and i[2] != '':
-                    self._application += "*DP &= *((cell_t*)" + str(i[2]) + ");\n"
-                elif i[1] == ':' and i[2] != '':
-                    self._application += "*DP &= *(DP + " + str(i[2]) + ");\n"
-                elif i[1] == '#' and i[2] != '':
-                    self._application += "*DP &= " + str(i[2]) + ";\n"
-                else:
-                    print(i)
-                    raise SyntaxError("Syntax error")
-            elif i[0] == '|':
-                if i[1] == '' and i[2] == '':
-                    self._application += "*DP |= *(DP+1);\n"
-                elif i[1] == '' and i[2] != '':
-                    self._application += "*DP |= *((cell_t*)" + str(i[2]) + ");\n"
-                elif i[1] == ':' and i[2] != '':
-                    self._application += "*DP |= *(DP + " + str(i[2]) + ");\n"
-                elif i[1] == '#' and i[2] != '':
-                    self._application += "*DP |= " + str(i[2]) + ";\n"
-                else:
-                    print(i)
-                    raise SyntaxError("Syntax error")
-            elif i[0] == '^':
-                if i[1] == '' and i[2] == '':
-                    self._application += "*DP ^= *(DP+1);\n"
-                elif i[1] == '' and i[2] != '':
-                    self._application += "*DP ^= *((cell_t*)" + str(i[2]) + ");\n"
-                elif i[1] == ':' and i[2] != '':
-                    self._application += "*DP ^= *(DP + " + str(i[2]) + ");\n"
-                elif i[1] == '#' and i[2] != '':
-                    self._application += "*DP ^= " + str(i[2]) + ";\n"
-                else:
-                    print(i)
-                    raise SyntaxError("Syntax error")
-            elif i[0] == '~':
-                if i[1] == '' and i[2] == '':
-                    self._application += "*DP = ~*DP;\n"
-                elif i[1] == '' and i[2] != '':
-                    self._application += "*DP = ~*((cell_t*)" + str(i[2]) + ");\n"
-                elif i[1] == ':' and i[2] != '':
-                    self._application += "*DP = ~*(DP + " + str(i[2]) + ");\n"
-                elif i[1] == '#' and i[2] != '':
-                    self._application += "*DP = ~" + str(i[2]) + ";\n"
-                else:
-                    print(i)
-                    raise SyntaxError("Syntax error")
-            elif i[0] == '\\':
-                if i[1] == '' and i[2] == '':
-                    self._application += "*DP <<= 1;\n"
-                elif i[1] == '' and i[2] != '':
-                    self._application += "*DP <<= *((cell_t*)" + str(i[2]) + ");\n"
-                elif i[1] == ':' and i[2] != '':
-                    self._application += "*DP <<= *(DP + " + str(i[2]) + ");\n"
-                elif i[1] == '#' and i[2] != '':
-                    self._application += "*DP <<= " + str(i[2]) + ";\n"
-                else:
-                    print(i)
-                    raise SyntaxError("Syntax error")
-            elif i[0] == '/':
-                if i[1] == '' and i[2] == '':
-                    self._application += "*DP >>= 1;\n"
-                elif i[1] == '' and i[2] != '':
-                    self._application += "*DP >>= *((cell_t*)" + str(i[2]) + ");\n"
-                elif i[1] == ':' and i[2] != '':
-                    self._application += "*DP >>= *(DP + " + str(i[2]) + ");\n"
-                elif i[1] == '#' and i[2] != '':
-                    self._application += "*DP >>= " + str(i[2]) + ";\n"
-                else:
-                    print(i)
-                    raise SyntaxError("Syntax error")
-            elif i[0] == '@':
-                if i[3] != '':
-                    print(i[3] + ":")
-                else:
-                    print(i)
-                    raise SyntaxError("Syntax error")
-            elif i[0] == '!':
-                if i[3] != '':
-                    self._application += "goto " + i[3] + ";\n"
-                else:
-                    print(i)
-                    raise SyntaxError("Syntax error")
+            if i.op == '@' and i.label != '':
+                if i.label in labels:
+                    raise self._error(i, "Duplicate label")
+                labels.add( i.label )
+
+        # Instrumented builds count every entry to a basic block: the start of the application, each
+        # loop iteration, the code after each loop and each label
+        self._counters = []
+        if self._instrument and instructions:
+            self._count( output, instructions[0], "start" )
+
+        # From TRACK_OFFSET_LEVEL on, constant moves only change the tracked offset, and the net
+        # movement is committed to dp before anything that needs dp itself: loops that are not
+        # balanced, dynamic moves, labels, jumps and external calls, and the end of the
+        # application
+        track = self._optimization >= TRACK_OFFSET_LEVEL
+        balanced = self._balanced_loops( instructions ) if track else set()
+        loops = []
+        self._offset = 0
+
+        for index, i in enumerate(instructions):
+            if track:
+                move = _static_move(i)
+                if i.op in ('>', '<') and move is not None:
+                    self._offset += move
+                    continue
+                if i.op == '[':
+                    loops.append( index in balanced )
+                    if not loops[-1]:
+                        self._commit( output )
+                elif i.op == ']':
+                    if loops and not loops.pop():
+                        self._commit( output )
+                elif move is None:
+                    self._commit( output )
+
+            if i.op == '_':
+                if i.mode == '' and i.operand == '':
+                    output.append( "__asm__ volatile (\"nop\");\n" )
+                else:
+                    raise self._error(i)
+            elif i.op == '>':
+                if i.mode == '' and i.operand == '':
+                    output.append( "dp += 1;\n" )
+                elif i.mode == '' and i.operand != '':
+                    output.append( "dp += *((cell_t*)" + str(i.operand) + ");\n" )
+                elif i.mode == ':' and i.operand != '':
+                    output.append( "dp += " + self._cell(i.operand) + ";\n" )
+                elif i.mode == '#' and i.operand != '':
+                    output.append( "dp += " + str(i.operand) + ";\n" )
+                else:
+                    raise self._error(i)
+            elif i.op == '<':
+                if i.mode == '' and i.operand == '':
+                    output.append( "dp -= 1;\n" )
+                elif i.mode == '' and i.operand != '':
+                    output.append( "dp -= *((cell_t*)" + str(i.operand) + ");\n" )
+                elif i.mode == ':' and i.operand != '':
+                    output.append( "dp -= " + self._cell(i.operand) + ";\n" )
+                elif i.mode == '#' and i.operand != '':
+                    output.append( "dp -= " + str(i.operand) + ";\n" )
+                else:
+                    raise self._error(i)
+            elif i.op == '+':
+                if i.mode == '' and i.operand == '':
+                    output.append( self._cell() + " += 1;\n" )
+                elif i.mode == '' and i.operand != '':
+                    output.append( self._cell() + " += *((cell_t*)" + str(i.operand) + ");\n" )
+                elif i.mode == ':' and i.operand != '':
+                    output.append( self._cell() + " += " + self._cell(i.operand) + ";\n" )
+                elif i.mode == '#' and i.operand != '':
+                    output.append( self._cell() + " += " + str(i.operand) + ";\n" )
+                else:
+                    raise self._error(i)
+            elif i.op == '-':
+                if i.mode == '' and i.operand == '':
+                    output.append( self._cell() + " -= 1;\n" )
+                elif i.mode == '' and i.operand != '':
+                    output.append( self._cell() + " -= *((cell_t*)" + str(i.operand) + ");\n" )
+                elif i.mode == ':' and i.operand != '':
+                    output.append( self._cell() + " -= " + self._cell(i.operand) + ";\n" )
+                elif i.mode == '#' and i.operand != '':
+                    output.append( self._cell() + " -= " + str(i.operand) + ";\n" )
+                else:
+                    raise self._error(i)
+            elif i.op == '[':
+                if i.mode == '' and i.operand == '':
+                    output.append( "while(" + self._cell() + "!=0) {\n" )
+                elif i.mode == '' and i.operand != '':
+                    output.append( "while(*((cell_t*)" + str(i.operand) + ")!=0) {\n" )
+                elif i.mode == ':' and i.operand != '':
+                    output.append( "while(" + self._cell(i.operand) + "!=0) {\n" )
+                elif i.mode == '#' and i.operand != '':
+                    output.append( "while(" + str(i.operand) + "!=0) {\n" )
+                else:
+                    raise self._error(i)
+            elif i.op == ']':
+                if i.mode == '' and i.operand == '':
+                    output.append( "}\n" )
+                else:
+                    raise self._error(i)
+            elif i.op == '.':
+                if i.mode == '' and i.operand == '':
+                    output.append( putchar + "(" + self._cell() + ");\n" )
+                elif i.mode == '' and i.operand != '':
+                    output.append( putchar + "(*((cell_t*)" + str(i.operand) + "));\n" )
+                elif i.mode == ':' and i.operand != '':
+                    output.append( putchar + "(" + self._cell(i.operand) + ");\n" )
+                elif i.mode == '#' and i.operand != '':
+                    output.append( putchar + "(" + str(i.operand) + ");\n" )
+                else:
+                    raise self._error(i)
+            elif i.op == ',':
+                if i.mode == '' and i.operand == '':
+                    output.append( self._cell() + "=" + getchar + "();\n" )
+                elif i.mode == '' and i.operand != '':
+                    output.append( "*((cell_t*)" + str(i.operand) + ")=" + getchar + "();\n" )
+                elif i.mode == ':' and i.operand != '':
+                    output.append( self._cell(i.operand) + "=" + getchar + "();\n" )
+                elif i.mode == '#' and i.operand != '':
+                    output.append( self._cell() + "=" + str(i.operand) + ";\n" )
+                else:
+                    raise self._error(i)
+            elif i.op == '&':
+                if i.mode == '' and i.operand == '':
+                    output.append( self._cell() + " &= " + self._cell(1) + ";\n" )
+                elif i.mode == '' and i.operand != '':
+                    output.append( self._cell() + " &= *((cell_t*)" + str(i.operand) + ");\n" )
+                elif i.mode == ':' and i.operand != '':
+                    output.append( self._cell() + " &= " + self._cell(i.operand) + ";\n" )
+                elif i.mode == '#' and i.operand != '':
+                    output.append( self._cell() + " &= " + str(i.operand) + ";\n" )
+                else:
+                    raise self._error(i)
+            elif i.op == '|':
+                if i.mode == '' and i.operand == '':
+                    output.append( self._cell() + " |= " + self._cell(1) + ";\n" )
+                elif i.mode == '' and i.operand != '':
+                    output.append( self._cell() + " |= *((cell_t*)" + str(i.operand) + ");\n" )
+                elif i.mode == ':' and i.operand != '':
+                    output.append( self._cell() + " |= " + self._cell(i.operand) + ";\n" )
+                elif i.mode == '#' and i.operand != '':
+                    output.append( self._cell() + " |= " + str(i.operand) + ";\n" )
+                else:
+                    raise self._error(i)
+            elif i.op == '^':
+                if i.mode == '' and i.operand == '':
+                    output.append( self._cell() + " ^= " + self._cell(1) + ";\n" )
+                elif i.mode == '' and i.operand != '':
+                    output.append( self._cell() + " ^= *((cell_t*)" + str(i.operand) + ");\n" )
+                elif i.mode == ':' and i.operand != '':
+                    output.append( self._cell() + " ^= " + self._cell(i.operand) + ";\n" )
+                elif i.mode == '#' and i.operand != '':
+                    output.append( self._cell() + " ^= " + str(i.operand) + ";\n" )
+                else:
+                    raise self._error(i)
+            elif i.op == '~':
+                if i.mode == '' and i.operand == '':
+                    output.append( self._cell() + " = ~" + self._cell() + ";\n" )
+                elif i.mode == '' and i.operand != '':
+                    output.append( self._cell() + " = ~*((cell_t*)" + str(i.operand) + ");\n" )
+                elif i.mode == ':' and i.operand != '':
+                    output.append( self._cell() + " = ~" + self._cell(i.operand) + ";\n" )
+                elif i.mode == '#' and i.operand != '':
+                    output.append( self._cell() + " = ~" + str(i.operand) + ";\n" )
+                else:
+                    raise self._error(i)
+            elif i.op == '\\':
+                if i.mode == '' and i.operand == '':
+                    output.append( self._cell() + " <<= 1;\n" )
+                elif i.mode == '' and i.operand != '':
+                    output.append( self._cell() + " <<= *((cell_t*)" + str(i.operand) + ");\n" )
+                elif i.mode == ':' and i.operand != '':
+                    output.append( self._cell() + " <<= " + self._cell(i.operand) + ";\n" )
+                elif i.mode == '#' and i.operand != '':
+                    output.append( self._cell() + " <<= " + str(i.operand) + ";\n" )
+                else:
+                    raise self._error(i)
+            elif i.op == '/':
+                if i.mode == '' and i.operand == '':
+                    output.append( self._cell() + " >>= 1;\n" )
+                elif i.mode == '' and i.operand != '':
+                    output.append( self._cell() + " >>= *((cell_t*)" + str(i.operand) + ");\n" )
+                elif i.mode == ':' and i.operand != '':
+                    output.append( self._cell() + " >>= " + self._cell(i.operand) + ";\n" )
+                elif i.mode == '#' and i.operand != '':
+                    output.append( self._cell() + " >>= " + str(i.operand) + ";\n" )
+                else:
+                    raise self._error(i)
+            elif i.op == '*':
+                # Multiply-accumulate produced by the optimizer
+                offset, factor = i.operand
+                if factor == 1:
+                    output.append( self._cell(offset) + " += " + self._cell() + ";\n" )
+                elif factor == -1:
+                    output.append( self._cell(offset) + " -= " + self._cell() + ";\n" )
+                elif factor > 0:
+                    output.append( self._cell(offset) + " += " + self._cell() + " * " + str(factor) + ";\n" )
+                else:
+                    output.append( self._cell(offset) + " -= " + self._cell() + " * " + str(-factor) + ";\n" )
+            elif i.op == '@':
+                if i.mode == '' and i.operand == '' and _LABEL.match(i.label):
+                    # The empty statement lets a label end a block
+                    output.append( i.label + ":;\n" )
+                else:
+                    raise self._error(i)
+            elif i.op == '!':
+                if i.label.startswith('(') and i.label.endswith(')') and len(i.label) > 2:
+                    # External functions may use DP, so it is only current around the call
+                    output.append( "DP = dp;\n" + i.label[1:-1] + "();\ndp = DP;\n" )
+                elif i.label in labels:
+                    output.append( "goto " + i.label + ";\n" )
+                elif i.label != '' and '(' not in i.label and ')' not in i.label:
+                    raise self._error(i, "Undefined label")
+                else:
+                    raise self._error(i)
             else:
-                print(i)
-                raise SyntaxError("Unknown instruction")
+                raise self._error(i, "Unknown instruction")
+
+            if self._instrument and i.op in _BLOCK_KINDS:
+                self._count( output, i, _BLOCK_KINDS[i.op] )
 
+        if track:
+            self._commit( output )
+        self._application = "".join(output)
         return self._application
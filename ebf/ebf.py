@@ -1,47 +1,303 @@
+import time
+_start_time = time.time()
+
 import os
 import sys
 import argparse
-from datetime import date
-from mako.template import Template
+import hashlib
 import compiler
+import frontend
+import optimizer
+
+# Written next to the outputs, holding the build hash they were generated from
+STAMP_FILE = ".ebf.stamp"
+OUTPUT_FILES = ("ebf.h", "main.c")
+# Sidecar written by instrumented builds, mapping each block counter to its source location
+COUNTER_MAP_FILE = "ebf_counters.map"
+TEMPLATE_FILES = ("ebf.h.mako", "main.c.mako")
+TEMPLATE_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), "templates")
+
+# Templates loaded by this process, by file name. Each worker process loads them once.
+_templates = {}
+
+# Seconds spent importing the compiler modules, reported by --timing
+_import_time = time.time() - _start_time
 
 class Ebf(object):
 
     def __init__(self):
         pass
 
+def build_hash(source, template_dir, optimization, instrument=False):
+    # Hash of everything the outputs depend on. The config block is part of the source, so it is
+    # covered by hashing the source.
+    h = hashlib.sha256()
+    for part in (compiler.VERSION, str(frontend.FORMAT_VERSION), str(optimization), str(instrument)):
+        h.update( part.encode("utf-8") + b"\0" )
+    for name in TEMPLATE_FILES:
+        with open(os.path.join(template_dir, name), 'rb') as f:
+            h.update( f.read() + b"\0" )
+    h.update( source.encode("utf-8") )
+    return h.hexdigest()
+
+def up_to_date(out_path, digest, names=OUTPUT_FILES):
+    # True if every output exists and was generated from a build with the same hash
+    for name in names:
+        if not os.path.isfile(os.path.join(out_path, name)):
+            return False
+    try:
+        with open(os.path.join(out_path, STAMP_FILE), 'r') as f:
+            return f.read().strip() == digest
+    except (IOError, OSError):
+        return False
+
+def write_if_changed(filename, text):
+    # Leave the file and its mtime alone when its contents would not change
+    try:
+        with open(filename, 'r') as f:
+            if f.read() == text:
+                return False
+    except (IOError, OSError):
+        pass
+    with open(filename, 'w') as f:
+        f.write(text)
+    return True
+
+def load_templates(module_directory=None, template_dir=TEMPLATE_DIR):
+    # Load the templates once per process. With a module_directory Mako keeps the compiled
+    # templates there, see template_module_dir().
+    if not _templates:
+        # Imported here so that up to date builds never pay for importing Mako
+        from mako.template import Template
+        for name in TEMPLATE_FILES:
+            _templates[name] = Template(filename=os.path.join(template_dir, name),
+                                        module_directory=module_directory)
+    return _templates
+
+def template_module_dir(cache_dir, template_dir=TEMPLATE_DIR):
+    # Compiled templates are kept per contents of the templates. Mako only recompiles a template
+    # when it is newer than its module, which misses templates replaced by older files, as when
+    # upgrading in place or checking out an older commit.
+    if cache_dir is None:
+        return None
+    h = hashlib.sha256( compiler.VERSION.encode("utf-8") + b"\0" )
+    for name in TEMPLATE_FILES:
+        with open(os.path.join(template_dir, name), 'rb') as f:
+            h.update( f.read() + b"\0" )
+    return os.path.join(cache_dir, "templates", h.hexdigest())
+
+def read_manifest(filename):
+    # A manifest lists one input per line, optionally followed by its output directory. Paths are
+    # relative to the manifest. Blank lines and lines starting with '#' are ignored.
+    base = os.path.dirname(filename)
+    jobs = []
+    with open(filename, 'r') as f:
+        for line in f:
+            fields = line.split()
+            if not fields or fields[0].startswith('#'):
+                continue
+            if len(fields) > 2:
+                raise ValueError("Too many fields in manifest {}: {}".format(filename, line.strip()))
+            infile = os.path.join(base, fields[0])
+            out_dir = os.path.join(base, fields[1]) if len(fields) == 2 else None
+            jobs.append( (infile, out_dir) )
+    return jobs
+
+def render(source, optimization=0, cache_dir=None, instrument=False):
+    # Compile source and render the outputs, returning their text by file name
+    c = compiler.Compiler(source, optimization=optimization, cache_dir=cache_dir, instrument=instrument)
+    c.compile()
+
+    templates = load_templates(template_module_dir(cache_dir))
+    kwargs = dict(c.config(), counter_count=len(c.counters()))
+    outputs = { "ebf.h": templates["ebf.h.mako"].render(strict_undefined=True, **kwargs),
+                "main.c": templates["main.c.mako"].render(strict_undefined=True, application=c.application(), **kwargs) }
+    if instrument:
+        outputs[COUNTER_MAP_FILE] = c.counter_map()
+    return outputs
+
+def write_outputs(out_path, outputs, digest):
+    if out_path and not os.path.isdir(out_path):
+        os.makedirs(out_path)
+
+    for name in sorted(outputs):
+        write_if_changed(os.path.join(out_path, name), outputs[name])
+
+    # Only stamp the outputs once all are written, so a failed build is never skipped
+    with open(os.path.join(out_path, STAMP_FILE), 'w') as f:
+        f.write(digest + "\n")
+
+def build(infile, out_path, optimization=0, cache_dir=None, always_make=False, recent=None,
+          instrument=False):
+    # Compile infile into ebf.h and main.c in out_path. Returns True if the outputs were
+    # regenerated and False if they were already up to date. recent is an optional dict-like
+    # cache of rendered outputs by build hash.
+    with open(infile, 'r') as f:
+        app = f.read()
+
+    digest = build_hash(app, TEMPLATE_DIR, optimization, instrument)
+    names = OUTPUT_FILES + (COUNTER_MAP_FILE,) if instrument else OUTPUT_FILES
+    if not always_make and up_to_date(out_path, digest, names):
+        return False
+
+    outputs = recent.get(digest) if recent is not None else None
+    if outputs is None:
+        outputs = render(app, optimization, cache_dir, instrument)
+        if recent is not None:
+            recent[digest] = outputs
+
+    write_outputs(out_path, outputs, digest)
+    return True
+
+def _report(infile, built, verbose):
+    if verbose:
+        print("{} {}.".format(infile, "built" if built else "is up to date"))
+
 def main():
     argparser = argparse.ArgumentParser( description="A python implementation of the Embedded "
                                                      "Brainfuck compiler." )
     argparser.add_argument( "-v", "--verbose", action='count',
                             help="Enable verbose output while compiling the program." )
-    argparser.add_argument( "infile",
-                            help="A file containing Embedded Brainfuck instructions." )
+    argparser.add_argument( "infiles", nargs='*', metavar="infile",
+                            help="Files containing Embedded Brainfuck instructions." )
+    argparser.add_argument( "-m", "--manifest", action="append", default=[],
+                            help="A file listing inputs to compile, one per line, each optionally "
+                                 "followed by its output directory." )
     argparser.add_argument( "--prefix", default="",
                             help="The prefix to add to all output files." )
     argparser.add_argument( "--out_dir", default="",
-                            help="The directory to write all output files to." )
+                            help="The directory to write all output files to. With several inputs "
+                                 "each is written to a subdirectory named after the input's path, "
+                                 "and without it next to the input." )
+    argparser.add_argument( "-O", "--optimize", type=int, default=0,
+                            choices=range(optimizer.MAX_LEVEL + 1),
+                            help="The optimization level. 1 folds repeated instructions and clear "
+                                 "loops, 2 also replaces multiply and copy loops, 3 also removes "
+                                 "constant data pointer moves by indexing cells from it." )
+    argparser.add_argument( "--instrument", action="store_true",
+                            help="Count every entry to each block of the application, writing "
+                                 "the counters to stderr when it ends and their source locations "
+                                 "to " + COUNTER_MAP_FILE + "." )
+    argparser.add_argument( "--cache_dir", default=frontend.default_cache_dir(),
+                            help="The directory to cache parsed programs in." )
+    argparser.add_argument( "--no_cache", action="store_true",
+                            help="Always parse the input instead of using the cache." )
+    argparser.add_argument( "-B", "--always_make", action="store_true",
+                            help="Regenerate the outputs even if they are up to date." )
+    argparser.add_argument( "-j", "--jobs", type=int, default=None,
+                            help="The number of worker processes. Defaults to the number of CPUs." )
+    argparser.add_argument( "--serve", nargs='?', const="", default=None, metavar="SOCKET",
+                            help="Run a compile server on a Unix socket, by default $EBF_SERVER or "
+                                 "server.sock in the cache directory." )
+    argparser.add_argument( "--connect", nargs='?', const="", default=None, metavar="SOCKET",
+                            help="Send the builds to a compile server instead of building them here. "
+                                 "Builds locally if no server is running." )
+    argparser.add_argument( "--timing", action="store_true",
+                            help="Print the time spent starting up and building to stderr." )
 
     args = argparser.parse_args()
 
-    with open(args.infile, 'r') as f:
-        app = f.read()
+    if args.serve is not None:
+        import server
+        server.serve(args.serve or server.default_address(), None if args.no_cache else args.cache_dir)
+        return
 
-    c = compiler.Compiler(app)
-    c.compile()
+    jobs = [ (infile, None) for infile in args.infiles ]
+    for manifest in args.manifest:
+        jobs.extend( read_manifest(manifest) )
+    if not jobs:
+        argparser.error("No input files given.")
+
+    builds = []
+    for infile, out_dir in jobs:
+        if out_dir is None:
+            if len(jobs) == 1:
+                out_dir = args.out_dir
+            elif args.out_dir:
+                # Mirror the input's path under out_dir
+                name = os.path.splitext(os.path.relpath(infile))[0]
+                if name.startswith(os.pardir):
+                    name = os.path.splitext(os.path.basename(infile))[0]
+                out_dir = os.path.join(args.out_dir, name)
+            else:
+                out_dir = os.path.dirname(infile)
+        builds.append( (infile, os.path.join(out_dir, args.prefix)) )
+
+    out_paths = [ os.path.normpath(out_path) for infile, out_path in builds ]
+    for out_path in set(out_paths):
+        if out_paths.count(out_path) > 1:
+            argparser.error("Several inputs would be written to {}.".format(out_path))
+
+    options = { "optimization": args.optimize,
+                "cache_dir": None if args.no_cache else args.cache_dir,
+                "always_make": args.always_make,
+                "instrument": args.instrument }
 
-    path = os.path.dirname(os.path.realpath(__file__))
-    ebf_h_template = Template(filename=os.path.join(path, "templates", "ebf.h.mako"))
-    main_c_template = Template(filename=os.path.join(path, "templates", "main.c.mako"))
-    kwargs = c.config()
+    build_start = time.time()
+    failed = None
+    if args.connect is not None:
+        failed = request_all(args.connect, builds, options, args.verbose)
+    if failed is None:
+        failed = build_all(builds, options, args.jobs, args.verbose)
+    if args.timing:
+        # Startup covers importing the compiler modules and parsing the arguments
+        sys.stderr.write("Startup: {:.1f} ms (imports {:.1f} ms), build: {:.1f} ms\n".format(
+            (build_start - _start_time) * 1000, _import_time * 1000,
+            (time.time() - build_start) * 1000))
 
-    with open(os.path.join( args.out_dir, args.prefix, "ebf.h"), 'w') as f:
-        f.write(ebf_h_template.render(strict_undefined=True, **kwargs))
+    if failed:
+        sys.exit("{} of {} inputs failed.".format(failed, len(builds)))
 
-    with open(os.path.join( args.out_dir, args.prefix, "main.c"), 'w') as f:
-        f.write(main_c_template.render(strict_undefined=True, application=c.application(), **kwargs))
+def build_all(builds, options, jobs=None, verbose=False):
+    # Build every (infile, out_path) and return the number of failed builds. A single input is
+    # built in this process and any error is raised.
+    if len(builds) == 1 or jobs == 1:
+        for infile, out_path in builds:
+            _report(infile, build(infile, out_path, **options), verbose)
+        return 0
+
+    # Each worker imports the compiler and loads the templates once, then builds many inputs
+    import concurrent.futures
+    failed = 0
+    module_directory = template_module_dir(options["cache_dir"])
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs, initializer=load_templates,
+                                                initargs=(module_directory,)) as executor:
+        futures = dict( (executor.submit(build, infile, out_path, **options), infile)
+                        for infile, out_path in builds )
+        for future in concurrent.futures.as_completed(futures):
+            infile = futures[future]
+            try:
+                _report(infile, future.result(), verbose)
+            except Exception as e:
+                failed += 1
+                sys.stderr.write("{}: {}\n".format(infile, e))
+    return failed
+
+def request_all(address, builds, options, verbose=False):
+    # Build on the compile server at address. Returns the number of failed builds, or None if no
+    # server is listening.
+    import server
+    options = { "optimization": options["optimization"], "always_make": options["always_make"],
+                "instrument": options["instrument"] }
+    failed = 0
+    responses = 0
+    try:
+        for response in server.request(address or server.default_address(), builds, options):
+            responses += 1
+            if "error" in response:
+                failed += 1
+                sys.stderr.write("{}: {}\n".format(response.get("infile", address), response["error"]))
+            else:
+                _report(response["infile"], response["built"], verbose)
+    except (IOError, OSError):
+        if responses:
+            # The server went away part way through
+            raise
+        if verbose:
+            print("No compile server, building locally.")
+        return None
+    return failed
 
 
 if __name__ == "__main__":
     main()
-
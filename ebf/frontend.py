@@ -0,0 +1,176 @@
+import re
+import os
+import json
+import hashlib
+import threading
+from collections import namedtuple, OrderedDict
+
+# Bumped whenever the lexer or the serialized layout changes, so stale cache entries are ignored
+FORMAT_VERSION = 3
+
+class SyntaxError(Exception):
+    def __init__(self, message, line=None, column=None):
+        if line is not None:
+            message = "Line {}, column {}: {}".format(line, column, message)
+        Exception.__init__(self, message)
+        self.message = message
+        self.line = line
+        self.column = column
+
+# A single instruction of the intermediate representation: the instruction character, the
+# modifier, the numeric operand, the label and where the instruction starts in the source.
+Instruction = namedtuple("Instruction", ["op", "mode", "operand", "label", "line", "column"])
+
+# Single pass lexer. Configuration blocks and comment lines are only recognized at the start of a
+# line; runs of other non-instruction characters are skipped in one match. Only labels and jumps
+# take a label, so a word after any other instruction, as in comments, is skipped.
+_LEXER = re.compile( r"(?P<config>^\#\%\((?P<yaml>[\s\S]*?)\))"
+                     r"|(?P<comment>^\#.*)"
+                     r"|(?P<newline>\n)"
+                     r"|(?P<op>[\@\!]|(?P<plain>[\_\>\<\+\-\[\]\.\,\|\&\^\~\\/]))(?P<mode>[\:\#])?(?P<operand>0[xX][a-fA-F0-9]+|\-?[0-9]+)?(?(plain)|(?P<label>\(?\w+\)?)?)"
+                     r"|[^\n\_\>\<\+\-\[\]\.\,\|\&\^\~\\/\@\!\#]+"
+                     r"|.", flags=re.MULTILINE )
+
+class RecentCache(object):
+    # Thread safe mapping holding the most recently used size entries
+
+    def __init__(self, size=128):
+        self._size = size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._entries:
+                return default
+            value = self._entries.pop(key)
+            self._entries[key] = value
+            return value
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = value
+            while len(self._entries) > self._size:
+                self._entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self._entries)
+
+# Applications recently loaded through load(), by cache key, so a long running process such as
+# the compile server does not even read the disk cache for them
+_recent = RecentCache()
+
+class Application(object):
+    # A parsed EBF application: the config block (None if there is none) and its instructions
+
+    def __init__(self, config, instructions):
+        self.config = config
+        self.instructions = instructions
+
+def c_int(text):
+    # Convert a number to an int the way a C compiler would read it
+    sign = 1
+    if text.startswith('-'):
+        sign = -1
+        text = text[1:]
+    if re.match("^0[xX][a-fA-F0-9]+$", text):
+        return sign * int(text, 16)
+    if re.match("^0[0-7]+$", text):
+        return sign * int(text, 8)
+    return sign * int(text, 10)
+
+def parse(source):
+    # Read the configuration block and tokenize the application in a single pass
+    config = None
+    instructions = []
+    config_found = False
+    line = 1
+    line_start = 0
+    for match in _LEXER.finditer( source ):
+        if match.group("op") is not None:
+            instructions.append( Instruction( match.group("op"), match.group("mode") or '',
+                                              match.group("operand") or '', match.group("label") or '',
+                                              line, match.start() - line_start + 1 ) )
+        elif match.group("newline") is not None:
+            line += 1
+            line_start = match.end()
+        elif match.group("config") is not None:
+            # Only one config block per application allowed
+            if config_found:
+                raise SyntaxError("Multiple config blocks.", line, match.start() - line_start + 1)
+            config_found = True
+            # Imported here so that cached builds never pay for importing yaml
+            import yaml
+            config = yaml.safe_load(match.group("yaml"))
+            newlines = match.group("config").count('\n')
+            if newlines > 0:
+                line += newlines
+                line_start = match.start() + match.group("config").rindex('\n') + 1
+
+    return Application( config, instructions )
+
+def dumps(app):
+    return json.dumps( { "version": FORMAT_VERSION,
+                         "config": app.config,
+                         "instructions": [ list(i) for i in app.instructions ] } )
+
+def loads(text):
+    data = json.loads( text )
+    if data.get("version") != FORMAT_VERSION:
+        raise ValueError( "Unsupported IR version: {}".format(data.get("version")) )
+    return Application( data["config"], [ Instruction(*i) for i in data["instructions"] ] )
+
+def default_cache_dir():
+    return os.environ.get( "EBF_CACHE_DIR",
+                           os.path.join(os.path.expanduser("~"), ".cache", "ebf") )
+
+def cache_key(source):
+    # The config block is part of the source, so hashing the source covers both
+    data = "{}\0{}".format(FORMAT_VERSION, source)
+    return hashlib.sha256( data.encode("utf-8") ).hexdigest()
+
+def load(source, cache_dir=None):
+    # Parse source, reusing the serialized IR from cache_dir if it has been parsed before.
+    # Without a cache_dir this is the same as parse().
+    if cache_dir is None:
+        return parse( source )
+
+    key = cache_key(source)
+    app = _recent.get( key )
+    if app is not None:
+        return app
+
+    path = os.path.join( cache_dir, key + ".json" )
+    try:
+        with open(path, 'r') as f:
+            app = loads( f.read() )
+        _recent[key] = app
+        return app
+    except (IOError, OSError, ValueError, KeyError, TypeError):
+        pass
+
+    app = parse( source )
+    _recent[key] = app
+    try:
+        text = dumps( app )
+    except (TypeError, ValueError):
+        # The config block holds something JSON can't represent, so don't cache it
+        return app
+
+    import tempfile
+    temp_path = None
+    try:
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        # Write to a temporary file first so concurrent builds never read a partial entry
+        handle, temp_path = tempfile.mkstemp( dir=cache_dir, suffix=".tmp" )
+        with os.fdopen(handle, 'w') as f:
+            f.write( text )
+        os.rename( temp_path, path )
+    except (IOError, OSError):
+        # Caching is best effort
+        if temp_path is not None and os.path.exists(temp_path):
+            os.remove(temp_path)
+
+    return app
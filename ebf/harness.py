@@ -0,0 +1,101 @@
+import io
+import concurrent.futures
+from collections import namedtuple
+import frontend
+from interpreter import Interpreter, PagedMemory
+
+# A run of the program named program with the given input and initial data array contents. The
+# data array has data_array_size cells, and the run stops with an error after step_limit steps.
+Job = namedtuple("Job", ["program", "stdin", "memory", "data_array_size", "step_limit"],
+                 defaults=(b"", b"", 1024, None))
+
+# The outcome of the job at index: its output, the steps it took if it was stepped, the final data
+# pointer, a copy of the final data array if it was kept, as the pages of a PagedMemory snapshot for
+# paged data arrays, and the error message if the job failed
+Result = namedtuple("Result", ["index", "output", "steps", "data_pointer", "memory", "error"])
+
+# Applications by program name and interpreters by (program name, data array size) in each worker
+_applications = {}
+_interpreters = {}
+
+
+def _initialize(applications):
+    # Each worker receives the parsed programs once and decodes each at most once
+    _applications.clear()
+    _applications.update( applications )
+    _interpreters.clear()
+
+def _interpreter(name, data_array_size):
+    key = (name, data_array_size)
+    if key not in _interpreters:
+        _interpreters[key] = Interpreter.from_app( _applications[name], data_array_size=data_array_size )
+    interpreter = _interpreters[key]
+    interpreter.reset()
+    return interpreter
+
+def _load_memory(data, memory):
+    # Copy memory into the start of the data array
+    if len(memory) > len(data):
+        raise ValueError( "Initial memory does not fit the data array: {}".format(len(memory)) )
+    if isinstance(data, bytearray):
+        data[:len(memory)] = memory
+    else:
+        for index, value in enumerate(memory):
+            data[index] = value
+
+def _copy_memory(data):
+    # Interpreter.snapshot() would move a flat data array onto pages for every later job
+    if isinstance(data, PagedMemory):
+        return data.snapshot()
+    return data[:]
+
+def run_job(index, job, step_limit=None, keep_memory=False):
+    # Run a single job in this process. Errors raised by the program are returned in the result.
+    job = Job( *job )
+    limit = job.step_limit if job.step_limit is not None else step_limit
+    interpreter = _interpreter( job.program, job.data_array_size )
+    interpreter.stdout = io.StringIO()
+    interpreter.stdin = job.stdin
+
+    steps = None
+    error = None
+    try:
+        _load_memory( interpreter.data_array, job.memory )
+        if limit is None:
+            interpreter.run()
+        else:
+            steps = 0
+            while steps < limit and interpreter.step():
+                steps += 1
+            # Programs ending on exactly the last allowed step are fine
+            if steps == limit and interpreter.step():
+                raise RuntimeError( "Step limit reached: {}".format(limit) )
+    except Exception as e:
+        error = "{}: {}".format( type(e).__name__, e )
+    finally:
+        interpreter.flush()
+
+    output = interpreter.stdout.getvalue().encode( "latin-1" )
+    memory = _copy_memory( interpreter.data_array ) if keep_memory else None
+    return Result( index, output, steps, interpreter.data_pointer, memory, error )
+
+def _run_chunk(chunk, step_limit, keep_memory):
+    return [ run_job(index, job, step_limit, keep_memory) for index, job in chunk ]
+
+def run_jobs(programs, jobs, workers=None, step_limit=None, keep_memory=False, chunk_size=16,
+             cache_dir=None):
+    # Run jobs across a pool of worker processes, yielding each Result as soon as its chunk of
+    # jobs finishes, so not in job order. programs maps program names to EBF source in the
+    # compiler's syntax. step_limit applies to jobs without their own; jobs without any limit
+    # run through Interpreter.run().
+    applications = dict( (name, frontend.load(source, cache_dir)) for name, source in programs.items() )
+    jobs = list(jobs)
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers, initializer=_initialize,
+                                                initargs=(applications,)) as executor:
+        futures = []
+        for start in range(0, len(jobs), chunk_size):
+            chunk = [ (index, jobs[index]) for index in range(start, min(start + chunk_size, len(jobs))) ]
+            futures.append( executor.submit(_run_chunk, chunk, step_limit, keep_memory) )
+        for future in concurrent.futures.as_completed(futures):
+            for result in future.result():
+                yield result
@@ -1,22 +1,576 @@
+import re
+import array
+import bisect
+import frontend
+from collections import namedtuple
+
+# Opcodes of the decoded program
+OP_RIGHT = 0
+OP_LEFT = 1
+OP_INC = 2
+OP_DEC = 3
+OP_OUTPUT = 4
+OP_INPUT = 5
+OP_OPEN = 6
+OP_CLOSE = 7
+OP_NOT = 8
+OP_SWAP_DP = 9
+OP_SWAP_IP = 10
+OP_AND = 11
+OP_OR = 12
+OP_XOR = 13
+OP_RSHIFT = 14
+OP_LSHIFT = 15
+OP_JUMP = 16
+OP_CALL = 17
+# Superinstructions produced by fuse()
+OP_ADD = 18             # Add operand to the current cell
+OP_MOVE = 19            # Add operand to the data pointer
+OP_CLEAR = 20           # [-] or [+]
+OP_SCAN = 21            # [>] or [<] with operand as the stride
+OP_MULTIPLY = 22        # [->+++<] with operand as ((offset, factor), ...)
+# Instructions only produced from the shared IR
+OP_NOP = 23             # _
+OP_LABEL = 24           # @label
+OP_EXTERN = 25          # !(func), calls a function registered in Interpreter.functions
+OP_COUNT = 26
+
+# Addressing modes of the decoded program
+MODE_NONE = 0
+MODE_AT = 1             # (I@N)
+MODE_AT_ABS = 2         # (I@*N)
+MODE_AT_REL = 3         # (I@:N)
+MODE_AT_REL_ABS = 4     # (I@:*N)
+MODE_LIT = 5            # (I#N)
+MODE_LIT_ABS = 6        # (I#*N)
+MODE_LIT_REL = 7        # (I#:N)
+MODE_LIT_REL_ABS = 8    # (I#:*N)
+MODE_COND_LIT = 9       # [#N, a loop on a literal condition
+MODE_MOVE_REL = 10      # >:N and <:N, move by the value at DP+N
+MODE_COUNT = 11
+
+_UNARY_OPCODES = { '>': OP_RIGHT, '<': OP_LEFT, '+': OP_INC, '-': OP_DEC,
+                   '.': OP_OUTPUT, ',': OP_INPUT, '[': OP_OPEN, ']': OP_CLOSE,
+                   '~': OP_NOT, '%': OP_SWAP_DP, '!': OP_SWAP_IP }
+
+_EXTENDED_OPCODES = { '>': OP_RIGHT, '<': OP_LEFT, '+': OP_INC, '-': OP_DEC,
+                      '.': OP_OUTPUT, ',': OP_INPUT, '[': OP_OPEN, ']': OP_CLOSE,
+                      '&': OP_AND, '|': OP_OR, '^': OP_XOR, '/': OP_RSHIFT,
+                      '\\': OP_LSHIFT }
+
+_MODES = { '@': MODE_AT, '@*': MODE_AT_ABS, '@:': MODE_AT_REL, '@:*': MODE_AT_REL_ABS,
+           '#': MODE_LIT, '#*': MODE_LIT_ABS, '#:': MODE_LIT_REL, '#:*': MODE_LIT_REL_ABS }
+
+# Shared IR instructions by character. '@', '!' and '_' are handled separately.
+_IR_OPCODES = { '>': OP_RIGHT, '<': OP_LEFT, '+': OP_INC, '-': OP_DEC,
+                '.': OP_OUTPUT, ',': OP_INPUT, '[': OP_OPEN, ']': OP_CLOSE,
+                '~': OP_NOT, '&': OP_AND, '|': OP_OR, '^': OP_XOR, '/': OP_RSHIFT,
+                '\\': OP_LSHIFT }
+
+# Decoded (opcode, mode, operand) of the plain IR instructions that have no plain decoded form
+_IR_PLAIN = { '&': (OP_AND, MODE_LIT_REL, 1), '|': (OP_OR, MODE_LIT_REL, 1),
+              '^': (OP_XOR, MODE_LIT_REL, 1), '\\': (OP_LSHIFT, MODE_LIT, 1),
+              '/': (OP_RSHIFT, MODE_LIT, 1) }
+
+# Decoded mode of an IR instruction with an operand, by character and IR modifier. The modifier
+# is '' for an absolute address, ':' for a relative address and '#' for a literal.
+_IR_MODES = { '>': { '': MODE_LIT_REL_ABS, ':': MODE_MOVE_REL, '#': MODE_LIT_REL },
+              '<': { '': MODE_LIT_REL_ABS, ':': MODE_MOVE_REL, '#': MODE_LIT_REL },
+              '[': { '': MODE_AT, ':': MODE_AT_REL, '#': MODE_COND_LIT },
+              ',': { '': MODE_AT, ':': MODE_AT_REL, '#': MODE_LIT } }
+_IR_DEFAULT_MODES = { '': MODE_LIT_ABS, ':': MODE_LIT_REL, '#': MODE_LIT }
+
+# Python source used by Interpreter.translate(). Address expressions resolve the target cell of an
+# '@' mode, source expressions the operand value of a '#' mode.
+_ADDRESS_EXPRESSIONS = { MODE_AT: "{0}", MODE_AT_ABS: "data[{0}]",
+                         MODE_AT_REL: "dp + {0}", MODE_AT_REL_ABS: "data[dp + {0}]" }
+_SOURCE_EXPRESSIONS = { MODE_LIT: "{0}", MODE_LIT_ABS: "data[{0}]",
+                        MODE_LIT_REL: "data[dp + {0}]", MODE_LIT_REL_ABS: "data[data[dp + {0}]]" }
+
+# Moves indexed by [opcode][(mode - MODE_AT) % 4]
+_MOVE_STATEMENTS = { OP_RIGHT: ("dp = {0}", "dp = data[{0}]", "dp += {0}", "dp += data[{0}]"),
+                     OP_LEFT: ("dp = {0}", "dp = data[{0}]", "dp -= {0}", "dp -= data[{0}]") }
+
+# New value of a cell written by a plain or '@' mode instruction, from the old value {0} and the
+# current cell {1}. Results are wrapped to the cell width with mask.
+_STORE_OPERATIONS = { OP_INC: "({0} + 1) & mask", OP_DEC: "({0} - 1) & mask",
+                      OP_OUTPUT: "{1}", OP_INPUT: "read()",
+                      OP_AND: "({0} & {1}) & mask", OP_OR: "({0} | {1}) & mask",
+                      OP_XOR: "({0} ^ {1}) & mask", OP_RSHIFT: "({0} >> {1}) & mask",
+                      OP_LSHIFT: "({0} << {1}) & mask" }
+
+# New value of the current cell {0} written by a '#' mode instruction with operand value {1}
+_UPDATE_OPERATIONS = { OP_INC: "({0} + {1}) & mask", OP_DEC: "({0} - {1}) & mask",
+                       OP_INPUT: "{1}",
+                       OP_AND: "({0} & {1}) & mask", OP_OR: "({0} | {1}) & mask",
+                       OP_XOR: "({0} ^ {1}) & mask", OP_RSHIFT: "({0} >> {1}) & mask",
+                       OP_LSHIFT: "({0} << {1}) & mask", OP_NOT: "(~{1}) & mask" }
+
+_EXTENDED_PATTERN = re.compile( r"\(([\>\<\+\-\.\,\[\]\&\|\^\\/])([\@\#]\:?\*?)(.*)\)" )
+_JUMP_PATTERN = re.compile( r"\(\!(\:?)([a-zA-Z][a-zA-Z0-9]*)\)" )
+_LABEL_PATTERN = re.compile( r"\(\@([a-zA-Z][a-zA-Z0-9]*)\)" )
+
+
+def _typecode(width):
+    # array typecode holding exactly width bits
+    for typecode in ('B', 'H', 'I', 'L', 'Q'):
+        if array.array(typecode).itemsize * 8 == width:
+            return typecode
+    return None
+
+# array typecodes for each cell width the compiler supports. 8 bit cells use a bytearray.
+_CELL_TYPECODES = dict( (width, _typecode(width)) for width in (8, 16, 32, 64) )
+
+# Data arrays with more cells than this are paged by default
+PAGED_THRESHOLD = 1 << 24
+
+# State captured by Interpreter.snapshot()
+Snapshot = namedtuple("Snapshot", ["memory", "instruction_pointer", "shadow_instruction_pointer",
+                                   "data_pointer", "shadow_data_pointer"])
+
+def new_data_array(size, cell_width=8):
+    # Zeroed data array for cells of the given width. Typed arrays reject values that do not fit,
+    # so arithmetic on them is still wrapped with the cell mask.
+    if cell_width == 8:
+        return bytearray(size)
+    return array.array( _CELL_TYPECODES[cell_width], [0] ) * size
+
+def config_options(app, options):
+    # options for an interpreter of app, with defaults taken from its config block
+    if app.config is not None and "cell_width" in app.config:
+        options.setdefault( "cell_width", app.config["cell_width"] )
+    if app.config is not None and "input_eof" in app.config:
+        options.setdefault( "eof", app.config["input_eof"] )
+    return options
+
+def find_zero(data, position, stride):
+    # Index of the first zero cell reached by repeatedly moving stride cells from position,
+    # wrapping around the array, or -1 if there is none
+    if isinstance(data, (PagedMemory, MappedMemory)):
+        return data.find_zero( position, stride )
+    if stride == 1 and isinstance(data, bytearray):
+        found = data.find( b'\x00', position )
+        if found < 0:
+            found = data.find( b'\x00' )
+        return found
+    if stride == -1 and isinstance(data, bytearray):
+        found = data.rfind( b'\x00', 0, position )
+        if found < 0:
+            found = data.rfind( b'\x00' )
+        return found
+    return _find_zero_by_cell( data, position, stride )
+
+def _find_zero_by_cell(data, position, stride):
+    # find_zero() reading one cell at a time
+    size = len(data)
+    for _ in range(size):
+        position = (position + stride) % size
+        if data[position] == 0:
+            return position
+    return -1
+
+def _find_zero_in_page(page, start, stride):
+    # Index of the first zero cell of page from start moving by stride (1 or -1), or -1
+    if isinstance(page, bytearray):
+        return page.find( b'\x00', start ) if stride == 1 else page.rfind( b'\x00', 0, start + 1 )
+    for index in (range(start, len(page)) if stride == 1 else range(start, -1, -1)):
+        if page[index] == 0:
+            return index
+    return -1
+
+
+class PagedMemory(object):
+    # Sparse data array of size cells, split into pages of page_size cells that are only allocated
+    # when first written. Cells of untouched pages read as zero. Indexing works like a flat data
+    # array, and the last pages read and written are kept so that runs of accesses to the same
+    # page only cost a shift and a compare.
+    #
+    # Pages are shared with snapshots until written. The first write to a page after snapshot()
+    # or restore() copies it and marks it dirty, and restoring the same snapshot only puts back
+    # the dirty pages.
+
+    def __init__(self, size, cell_width=8, page_size=4096):
+        if page_size <= 0 or page_size & (page_size - 1):
+            raise ValueError( "Page size must be a power of two: {}".format(page_size) )
+        self._size = size
+        self._cell_width = cell_width
+        self._page_size = page_size
+        self._shift = page_size.bit_length() - 1
+        self._offset_mask = page_size - 1
+        self._pages = {}
+        self._dirty = set()
+        self._base = None
+        self._reset_hot()
+
+    def pages():
+        doc = "The allocated pages as a dictionary of page number to page."
+        def fget(self):
+            return self._pages
+        return locals()
+    pages = property(**pages())
+
+    def page_size():
+        doc = "The number of cells in each page."
+        def fget(self):
+            return self._page_size
+        return locals()
+    page_size = property(**page_size())
+
+    def dirty():
+        doc = "Numbers of the pages written since the last snapshot() or restore()."
+        def fget(self):
+            return self._dirty
+        return locals()
+    dirty = property(**dirty())
+
+    def __len__(self):
+        return self._size
+
+    def __getitem__(self, index):
+        try:
+            if index >> self._shift == self._read_number:
+                return self._read_page[index & self._offset_mask]
+        except TypeError:
+            return [ self[i] for i in range(*index.indices(self._size)) ]
+        page, offset = self._page( index, False )
+        if page is None:
+            return 0
+        return page[offset]
+
+    def __setitem__(self, index, value):
+        if index >> self._shift == self._write_number:
+            self._write_page[index & self._offset_mask] = value
+        else:
+            page, offset = self._page( index, True )
+            page[offset] = value
+
+    def _page(self, index, write):
+        # Page holding index and the offset of index in it, making the page the hot page. Pages
+        # written for the first time since a snapshot are copied or allocated; reading an
+        # untouched page returns None.
+        if index < 0:
+            index += self._size
+        if not 0 <= index < self._size:
+            raise IndexError( "Data array index out of range: {}".format(index) )
+        number = index >> self._shift
+        page = self._pages.get( number )
+        if write:
+            if number not in self._dirty:
+                if page is None:
+                    # The last page is cut short so that indexing it past the end still fails
+                    length = min( self._page_size, self._size - (number << self._shift) )
+                    page = new_data_array( length, self._cell_width )
+                else:
+                    page = page[:]
+                self._pages[number] = page
+                self._dirty.add( number )
+            self._write_number = number
+            self._write_page = page
+        elif page is None:
+            return None, 0
+        self._read_number = number
+        self._read_page = page
+        return page, index & self._offset_mask
+
+    def _reset_hot(self):
+        self._read_number = None
+        self._read_page = None
+        self._write_number = None
+        self._write_page = None
+
+    def clear(self):
+        # Zero every cell, in time proportional to the pages touched
+        self._pages.clear()
+        self._dirty.clear()
+        self._base = None
+        self._reset_hot()
+
+    def load(self, data):
+        # Replace every cell with the cells of the flat data array data, which has the same size.
+        # Only its pages holding a non-zero cell are allocated.
+        self.clear()
+        zero = new_data_array( self._page_size, self._cell_width )
+        for base in range(0, self._size, self._page_size):
+            page = data[base:base + self._page_size]
+            if page != zero[:len(page)]:
+                self._pages[base >> self._shift] = page
+
+    def snapshot(self):
+        # The current pages, shared with the memory until they are next written
+        pages = dict(self._pages)
+        self._base = pages
+        self._dirty.clear()
+        self._reset_hot()
+        return pages
+
+    def restore(self, pages):
+        # Return to a snapshot. Restoring the snapshot taken or restored last only puts back the
+        # pages written since; any other snapshot replaces every page.
+        if pages is self._base:
+            for number in self._dirty:
+                if number in pages:
+                    self._pages[number] = pages[number]
+                else:
+                    del self._pages[number]
+        else:
+            self._pages = dict(pages)
+            self._base = pages
+        self._dirty.clear()
+        self._reset_hot()
+
+    def find_zero(self, position, stride):
+        # find_zero() for a paged data array. Untouched pages are all zero and never searched.
+        position %= self._size
+        if stride not in (1, -1):
+            for _ in range(self._size):
+                position = (position + stride) % self._size
+                if self[position] == 0:
+                    return position
+            return -1
+        count = (self._size + self._page_size - 1) >> self._shift
+        number = position >> self._shift
+        # The starting page is visited again at the end for the cells before the start
+        for visit in range(count + 1):
+            base = number << self._shift
+            page = self._pages.get( number )
+            if page is None:
+                if visit == 0:
+                    return position
+                length = min( self._page_size, self._size - base )
+                return base if stride == 1 else base + length - 1
+            if visit == 0:
+                start = position - base
+            else:
+                start = 0 if stride == 1 else len(page) - 1
+            found = _find_zero_in_page( page, start, stride )
+            if found >= 0:
+                return base + found
+            number = (number + stride) % count
+        return -1
+
+
+class MappedMemory(object):
+    # View of a data array that sends accesses to memory mapped regions to Python handlers.
+    # Regions are kept sorted by start address and looked up with a binary search, but only for
+    # addresses between the lowest and the highest mapped address. The interpreter only runs the
+    # instructions that may access a mapped cell against this view.
+
+    def __init__(self, memory, cell_mask):
+        self._memory = memory
+        self._cell_mask = cell_mask
+        self._starts = []
+        self._regions = []
+        self._low = 0
+        self._high = 0
+
+    def memory():
+        doc = "The underlying data array."
+        def fget(self):
+            return self._memory
+        def fset(self, value):
+            self._memory = value
+        return locals()
+    memory = property(**memory())
+
+    def regions():
+        doc = "The mapped regions as (start, stop, read, write) tuples sorted by start."
+        def fget(self):
+            return list(self._regions)
+        return locals()
+    regions = property(**regions())
+
+    def bounds():
+        doc = "The lowest mapped address and one past the highest, as (low, high)."
+        def fget(self):
+            return (self._low, self._high)
+        return locals()
+    bounds = property(**bounds())
+
+    def __len__(self):
+        return len(self._memory)
+
+    def __getitem__(self, index):
+        try:
+            if not self._low <= index < self._high:
+                return self._memory[index]
+        except TypeError:
+            return [ self[i] for i in range(*index.indices(len(self._memory))) ]
+        region = self._region( index )
+        if region is None or region[2] is None:
+            return self._memory[index]
+        return region[2]( index ) & self._cell_mask
+
+    def __setitem__(self, index, value):
+        if self._low <= index < self._high:
+            region = self._region( index )
+            if region is not None and region[3] is not None:
+                region[3]( index, value )
+                return
+        self._memory[index] = value
+
+    def find_zero(self, position, stride):
+        # Scans with a unit stride search the underlying memory, unless they pass the mapped
+        # bounds before stopping. Those and all other scans read each cell through this view.
+        if stride in (1, -1):
+            found = find_zero( self._memory, position, stride )
+            if found >= 0 and not self._passes_mapped( position, found, stride ):
+                return found
+        return _find_zero_by_cell( self, position, stride )
+
+    def _passes_mapped(self, position, found, stride):
+        # True if a unit stride scan from position to found reads a cell between the mapped bounds
+        size = len(self._memory)
+        if stride == 1:
+            spans = [ (position, found + 1) ] if found >= position else [ (position, size), (0, found + 1) ]
+        else:
+            spans = [ (found, position + 1) ] if found <= position else [ (0, position + 1), (found, size) ]
+        for start, stop in spans:
+            if start < self._high and self._low < stop:
+                return True
+        return False
+
+    def _region(self, index):
+        # The region containing index, or None if it falls between regions
+        position = bisect.bisect_right( self._starts, index ) - 1
+        if position >= 0 and index < self._regions[position][1]:
+            return self._regions[position]
+        return None
+
+    def map(self, start, stop, read=None, write=None):
+        # Map cells start to stop - 1. Regions may not overlap.
+        if not 0 <= start < stop <= len(self._memory):
+            raise ValueError( "Invalid memory mapped region: {}-{}".format(start, stop) )
+        position = bisect.bisect_right( self._starts, start )
+        if ( (position > 0 and self._regions[position - 1][1] > start) or
+             (position < len(self._starts) and self._starts[position] < stop) ):
+            raise ValueError( "Memory mapped region overlaps another: {}-{}".format(start, stop) )
+        self._starts.insert( position, start )
+        self._regions.insert( position, (start, stop, read, write) )
+        self._update_bounds()
+
+    def unmap(self, start):
+        # Remove the region starting at start
+        position = bisect.bisect_left( self._starts, start )
+        if position == len(self._starts) or self._starts[position] != start:
+            raise ValueError( "No memory mapped region starts at {}".format(start) )
+        del self._starts[position]
+        del self._regions[position]
+        self._update_bounds()
+
+    def _update_bounds(self):
+        # Regions do not overlap, so the last one ends highest
+        if self._regions:
+            self._low = self._regions[0][0]
+            self._high = self._regions[-1][1]
+        else:
+            self._low = self._high = 0
+
+
+class _MultiplyGuard(object):
+    # The data pointers for which a multiply loop accessing the cells at offsets from the data
+    # pointer may access a cell from low to high - 1. Its targets wrap around the data array of
+    # size cells, so data pointers for which any target would wrap are included as well.
+
+    def __init__(self, offsets, low, high, size):
+        self._hits = range( low - max(offsets), high - min(offsets) )
+        self._unwrapped = range( -min(offsets), size - max(offsets) )
+
+    def __contains__(self, dp):
+        return dp in self._hits or dp not in self._unwrapped
+
+    def expression(self, dp):
+        # Python expression for dp being in the guard
+        return "{1} <= {0} < {2} or not {3} <= {0} < {4}".format( dp, self._hits.start, self._hits.stop,
+                                                                  self._unwrapped.start, self._unwrapped.stop )
+
+
 class Interpreter(object):
 
-    def __init__(self, app, data_array_size=1024):
+    def __init__(self, app, data_array_size=1024, optimize=True, cell_width=8, output_chunk=4096,
+                 input_chunk=4096, eof=-1, paged=None, page_size=4096):
+        if cell_width not in _CELL_TYPECODES:
+            raise ValueError( "Unknown cell width: {}".format(cell_width) )
         self._app = app
+        self._cell_width = cell_width
+        self._cell_mask = (1 << cell_width) - 1
         self._data_array_size = data_array_size
-        self._data_array = bytearray(b'\x00' * data_array_size)
+
+        # Data arrays larger than PAGED_THRESHOLD cells, such as a full 32 bit address space, are
+        # paged unless paged says otherwise. A flat array is faster to index.
+        if paged is None:
+            paged = data_array_size > PAGED_THRESHOLD
+        self._page_size = page_size
+        if paged:
+            self._data_array = PagedMemory( data_array_size, cell_width, page_size )
+        else:
+            self._data_array = new_data_array( data_array_size, cell_width )
         self._instruction_pointer = 0
         self._shadow_instruction_pointer = 0
         self._data_pointer = 0
         self._shadow_data_pointer = 0
 
         self._debug = 0
+        self._profile = False
+        self._instruction_counts = None
+        self._loop_counts = None
+
+        # Output is gathered here and written to stdout every output_chunk bytes, before input is
+        # read and when the program stops
+        self._output_buffer = bytearray()
+        self._output_chunk = output_chunk
+
+        # Input is served from _input, refilled from stdin input_chunk bytes at a time. At the
+        # end of input, ',' stores eof (masked to the cell width like the generated C's EOF), or
+        # raises EOFError if eof is None.
+        self._stdin = None
+        self._input_buffer = b''
+        self._input_position = 0
+        self._input_chunk = input_chunk
+        self._eof = eof
+
+        # The decoded program and, with optimize, the fused one, each with the tables indexing it.
+        # The fused program runs unless peripherals are mapped, see map_io().
+        decoded = self.decode( app.instructions )
+        self._programs = { False: self._prepare( decoded, list(range(len(decoded))) ) }
+        if optimize:
+            self._programs[True] = self._prepare( *self.fuse(decoded) )
+        self._optimize = optimize
+        self._fused = None
+        self._select_program( optimize )
+        self._functions = {}
+        self._dispatch = self._build_dispatch()
+        self._compiled = None
+
+        # While peripherals are mapped, _mapped holds them and _io_guards has the data pointers
+        # for which each instruction may access a mapped cell, see _io_guard()
+        self._mapped = None
+        self._io_guards = None
+
+    @classmethod
+    def from_source(cls, source, cache_dir=None, **kwargs):
+        # Interpreter for EBF source in the compiler's syntax, parsed through the shared front end
+        return cls.from_app( frontend.load(source, cache_dir), **kwargs )
+
+    @classmethod
+    def from_app(cls, app, **kwargs):
+        # Interpreter for an application parsed by the front end, honouring its config block
+        return cls( app, **config_options(app, kwargs) )
 
     def stdin():
-        doc = "The stdin property."
+        doc = "The stdin property. Either a file object or the input itself as bytes, bytearray or memoryview."
         def fget(self):
+            if self._stdin is None:
+                return self._input_buffer
             return self._stdin
         def fset(self, value):
-            self._stdin = value
+            self._input_position = 0
+            if isinstance(value, (bytes, bytearray, memoryview)):
+                # Served directly, without copying
+                self._stdin = None
+                self._input_buffer = memoryview(value).cast('B')
+            else:
+                self._stdin = value
+                self._input_buffer = b''
         def fdel(self):
             del self._stdin
         return locals()
@@ -27,6 +581,8 @@ class Interpreter(object):
         def fget(self):
             return self._stdout
         def fset(self, value):
+            if hasattr(self, "_stdout"):
+                self.flush()
             self._stdout = value
         def fdel(self):
             del self._stdout
@@ -39,393 +595,1065 @@ class Interpreter(object):
             return self._debug
         def fset(self, value):
             self._debug = value
+            self._install_step()
         def fdel(self):
             del self._debug
         return locals()
     debug = property(**debug())
 
+    def profile():
+        doc = "The profile property. Setting it clears the counts and starts counting every instruction and loop iteration."
+        def fget(self):
+            return self._profile
+        def fset(self, value):
+            self._profile = bool(value)
+            if self._profile:
+                self._instruction_counts = array.array( 'L', [0] ) * len(self._program)
+                self._loop_counts = array.array( 'L', [0] ) * len(self._program)
+            self._install_step()
+        return locals()
+    profile = property(**profile())
+
+    def instruction_counts():
+        doc = "Executions of each decoded instruction while profiling."
+        def fget(self):
+            return self._instruction_counts
+        return locals()
+    instruction_counts = property(**instruction_counts())
+
+    def loop_counts():
+        doc = "Iterations of the loop opened by each '[' while profiling, indexed like program."
+        def fget(self):
+            return self._loop_counts
+        return locals()
+    loop_counts = property(**loop_counts())
+
+    def data_array():
+        doc = "The data array, flat or a PagedMemory. A flat data array is replaced by a PagedMemory at the first snapshot() or restore(). Accesses through it bypass mapped peripherals."
+        def fget(self):
+            return self._data_array
+        return locals()
+    data_array = property(**data_array())
+
+    def data_pointer():
+        doc = "The data pointer."
+        def fget(self):
+            return self._data_pointer
+        return locals()
+    data_pointer = property(**data_pointer())
+
+    def program():
+        doc = "The program being run as a list of (opcode, mode, operand) tuples, fused unless optimize is off or peripherals are mapped. Gotos and calls have the index of their label as the operand."
+        def fget(self):
+            return self._program
+        return locals()
+    program = property(**program())
+
+    def functions():
+        doc = "Functions called by '!(name)', by name. Each is called with the interpreter."
+        def fget(self):
+            return self._functions
+        return locals()
+    functions = property(**functions())
+
+    @staticmethod
+    def decode(instructions):
+        # Translate the instruction strings, or the shared IR produced by frontend.parse(), into
+        # (opcode, mode, operand) tuples once, so that executing an instruction never has to parse
+        # it again. An operand of None stands for the shadow data pointer, which is only known at
+        # run time.
+        program = []
+        open_brackets = []
+        for index, instruction in enumerate(instructions):
+            if isinstance(instruction, tuple):
+                decoded = Interpreter._decode_ir( instruction )
+                if decoded[0] == OP_OPEN:
+                    open_brackets.append( decoded )
+                elif decoded[0] == OP_CLOSE and open_brackets:
+                    # Like the generated C while loop, ']' re-checks the condition of its '['
+                    decoded = (OP_CLOSE,) + open_brackets.pop()[1:]
+                program.append( decoded )
+                continue
+
+            if instruction in _UNARY_OPCODES:
+                program.append( (_UNARY_OPCODES[instruction], MODE_NONE, 0) )
+                continue
+
+            match = _EXTENDED_PATTERN.match( instruction )
+            if match is not None:
+                if match.group(2) not in _MODES:
+                    raise SyntaxError("Unexpected modifiers in {}: {}".format(instruction, index))
+                if match.group(3) == '%':
+                    operand = None
+                else:
+                    try:
+                        operand = int(match.group(3),0)
+                    except ValueError:
+                        raise SyntaxError("Invalid operand in {}: {}".format(instruction, index))
+                program.append( (_EXTENDED_OPCODES[match.group(1)], _MODES[match.group(2)], operand) )
+                continue
+
+            match = _JUMP_PATTERN.match( instruction )
+            if match is not None:
+                opcode = OP_CALL if match.group(1) == ':' else OP_JUMP
+                program.append( (opcode, MODE_NONE, match.group(2)) )
+                continue
+
+            match = _LABEL_PATTERN.match( instruction )
+            if match is not None:
+                program.append( (OP_LABEL, MODE_NONE, match.group(1)) )
+                continue
+
+            raise SyntaxError("Unknown instruction: {}: {}".format(index,instruction))
+
+        return program
+
+    @staticmethod
+    def _decode_ir(i):
+        # Decode a single frontend.Instruction with the semantics of the generated C
+        def error(message="Syntax error"):
+            text = i.op + i.mode + str(i.operand) + i.label
+            return SyntaxError( "Line {}, column {}: {}: {}".format(i.line, i.column, message, text) )
+
+        if i.op == '_':
+            if i.mode != '' or i.operand != '':
+                raise error()
+            return (OP_NOP, MODE_NONE, 0)
+        if i.op == '@':
+            if i.label == '' or i.mode != '' or i.operand != '':
+                raise error()
+            return (OP_LABEL, MODE_NONE, i.label)
+        if i.op == '!':
+            # !label jumps, !:label calls, a bare ! returns to after the last call and !(func)
+            # calls an external function
+            if i.operand != '' or i.mode not in ('', ':') or (i.mode == ':' and i.label.startswith('(')):
+                raise error()
+            if i.label == '':
+                return (OP_SWAP_IP, MODE_NONE, 0)
+            if i.mode == ':':
+                return (OP_CALL, MODE_NONE, i.label)
+            if i.label.startswith('('):
+                return (OP_EXTERN, MODE_NONE, i.label.strip('()'))
+            return (OP_JUMP, MODE_NONE, i.label)
+        if i.op not in _IR_OPCODES:
+            raise error("Unknown instruction")
+
+        if i.mode == '' and i.operand == '' and i.label == '':
+            return _IR_PLAIN.get( i.op, (_IR_OPCODES[i.op], MODE_NONE, 0) )
+        if i.operand == '' or i.mode not in _IR_DEFAULT_MODES or i.op == ']' or i.label != '':
+            raise error()
+        mode = _IR_MODES.get( i.op, _IR_DEFAULT_MODES )[i.mode]
+        return (_IR_OPCODES[i.op], mode, frontend.c_int(i.operand))
+
+    @staticmethod
+    def fuse(program):
+        # Combine runs of '+'/'-' and '>'/'<' into counted superinstructions, then replace clear,
+        # scan and multiply loops with a single instruction each. Returns the fused program and the
+        # index of the instruction each fused entry started from.
+        fused = []
+        source_map = []
+        for index, (opcode, mode, operand) in enumerate(program):
+            if opcode == OP_NOP:
+                continue
+            if mode == MODE_NONE and opcode in (OP_INC, OP_DEC, OP_RIGHT, OP_LEFT):
+                kind = OP_ADD if opcode in (OP_INC, OP_DEC) else OP_MOVE
+                amount = 1 if opcode in (OP_INC, OP_RIGHT) else -1
+                if fused and fused[-1][0] == kind:
+                    fused[-1] = (kind, MODE_NONE, fused[-1][2] + amount)
+                else:
+                    fused.append( (kind, MODE_NONE, amount) )
+                    source_map.append( index )
+                continue
+            fused.append( (opcode, mode, operand) )
+            source_map.append( index )
+
+        result = []
+        result_map = []
+        index = 0
+        while index < len(fused):
+            if fused[index] == (OP_OPEN, MODE_NONE, 0):
+                end = index + 1
+                while end < len(fused) and fused[end][0] in (OP_ADD, OP_MOVE):
+                    end += 1
+                if end < len(fused) and fused[end] == (OP_CLOSE, MODE_NONE, 0):
+                    replacement = Interpreter._fuse_loop( fused[index+1:end] )
+                    if replacement is not None:
+                        result.append( replacement )
+                        result_map.append( source_map[index] )
+                        index = end + 1
+                        continue
+            if fused[index][0] == OP_ADD and fused[index][2] == 0:
+                # Adds that cancel out do nothing. Moves that cancel out are kept, since every
+                # move wraps the data pointer into the array.
+                index += 1
+                continue
+            result.append( fused[index] )
+            result_map.append( source_map[index] )
+            index += 1
+
+        return result, result_map
+
+    @staticmethod
+    def _fuse_loop(body):
+        # Superinstruction equivalent to a loop made only of adds and moves, or None
+        if len(body) == 1 and body[0][0] == OP_ADD and body[0][2] in (1, -1):
+            return (OP_CLEAR, MODE_NONE, 0)
+        if len(body) == 1 and body[0][0] == OP_MOVE and body[0][2] != 0:
+            return (OP_SCAN, MODE_NONE, body[0][2])
+
+        offset = 0
+        deltas = {}
+        for opcode, mode, amount in body:
+            if opcode == OP_MOVE:
+                offset += amount
+            else:
+                deltas[offset] = deltas.get(offset, 0) + amount
+        if offset != 0 or deltas.get(0) != -1:
+            return None
+        # The loop runs once per unit in the current cell, adding factor to each other cell
+        terms = tuple( (k, v) for k, v in sorted(deltas.items()) if k != 0 and v != 0 )
+        return (OP_MULTIPLY, MODE_NONE, terms)
+
+    @staticmethod
+    def match_brackets(program):
+        # Pair every '[' with its ']' so loops jump in constant time. Each bracket's entry is the
+        # index of its partner; all other entries are None.
+        jump_table = [None] * len(program)
+        open_brackets = []
+        for index, (opcode, mode, operand) in enumerate(program):
+            if opcode == OP_OPEN:
+                open_brackets.append( index )
+            elif opcode == OP_CLOSE:
+                if not open_brackets:
+                    raise SyntaxError("Unmatched ']': {}".format(index))
+                partner = open_brackets.pop()
+                jump_table[partner] = index
+                jump_table[index] = partner
+
+        if open_brackets:
+            raise SyntaxError("Unmatched '[': {}".format(open_brackets[-1]))
+
+        return jump_table
+
+    @staticmethod
+    def find_labels(program):
+        # Map each '@label' to the index of its instruction
+        labels = {}
+        for index, (opcode, mode, operand) in enumerate(program):
+            if opcode == OP_LABEL:
+                if operand in labels:
+                    raise SyntaxError("Duplicate label: {}: {}".format(operand, index))
+                labels[operand] = index
+        return labels
+
+    @staticmethod
+    def resolve_labels(program, labels):
+        # Replace the label name operand of every goto and call with the index of the label's
+        # instruction, so jumping never looks the name up. Undefined labels are reported here,
+        # before anything runs.
+        resolved = []
+        for index, (opcode, mode, operand) in enumerate(program):
+            if opcode in (OP_JUMP, OP_CALL):
+                if operand not in labels:
+                    raise SyntaxError("Undefined label: {}: {}".format(operand, index))
+                operand = labels[operand]
+            resolved.append( (opcode, mode, operand) )
+        return resolved
+
+    @staticmethod
+    def _prepare(program, source_map):
+        # program with its labels resolved, its source map, jump table and labels
+        jump_table = Interpreter.match_brackets( program )
+        labels = Interpreter.find_labels( program )
+        return Interpreter.resolve_labels( program, labels ), source_map, jump_table, labels
+
+    def _select_program(self, fused):
+        # Run the fused or the decoded program from the same point. Returns False and changes
+        # nothing if the instruction pointer is inside instructions that were fused into one.
+        # Profile counts are per program, so switching clears them.
+        if fused == self._fused:
+            return True
+        program, source_map, jump_table, labels = self._programs[fused]
+        if self._fused is not None:
+            ip = self._instruction_pointer
+            if ip == 0:
+                pass
+            elif not 0 < ip < len(self._program):
+                ip = len(program)
+            elif not fused:
+                ip = self._decoded_position( ip )
+            else:
+                positions = [ self._decoded_position(index) for index in range(len(program)) ]
+                if ip not in positions:
+                    return False
+                ip = positions.index( ip )
+            self._instruction_pointer = ip
+        self._program = program
+        self._source_map = source_map
+        self._jump_table = jump_table
+        self._identifier_dict = labels
+        self._fused = fused
+        self._compiled = None
+        if self._profile:
+            self._instruction_counts = array.array( 'L', [0] ) * len(self._program)
+            self._loop_counts = array.array( 'L', [0] ) * len(self._program)
+        return True
+
+    def _decoded_position(self, index):
+        # Index in the decoded program where the fused program is at index: just after the
+        # instructions fused into the entry before it. Adds that cancel out are not in the fused
+        # program, so any between the two entries are still to run.
+        if index == 0:
+            return 0
+        decoded, _, jump_table, _ = self._programs[False]
+        fused, source_map, _, _ = self._programs[True]
+        opcode = fused[index - 1][0]
+        position = source_map[index - 1]
+        if opcode in (OP_CLEAR, OP_SCAN, OP_MULTIPLY):
+            return jump_table[position] + 1
+        if opcode in (OP_ADD, OP_MOVE):
+            kinds = (OP_INC, OP_DEC) if opcode == OP_ADD else (OP_RIGHT, OP_LEFT)
+            while position < len(decoded) and ( decoded[position][0] == OP_NOP or
+                                                (decoded[position][0] in kinds and decoded[position][1] == MODE_NONE) ):
+                position += 1
+            return position
+        return position + 1
+
+    def find_matching_bracket(self, index):
+        return self._jump_table[index]
+
     def reset(self):
-        # reset the program
-        self._data_array = bytearray(b'\x00' * self._data_array_size)
+        # reset the program. Memory mapped regions stay mapped.
+        if isinstance(self._data_array, PagedMemory):
+            self._data_array.clear()
+        else:
+            self._data_array = new_data_array( self._data_array_size, self._cell_width )
         self._instruction_pointer = 0
         self._shadow_instruction_pointer = 0
         self._data_pointer = 0
         self._shadow_data_pointer = 0
+        # Peripherals unmapped partway through a fused instruction left the program unfused
+        self._select_program( self._optimize and self._mapped is None )
+
+    def snapshot(self):
+        # Capture the data array, both pointers and both shadow registers for restore(). The data
+        # array shares its pages with the snapshot and copies a page on its next write, so
+        # snapshot() and restore() cost time proportional to the pages written in between.
+        self._page_data_array()
+        return Snapshot( self._data_array.snapshot(), self._instruction_pointer, self._shadow_instruction_pointer,
+                         self._data_pointer, self._shadow_data_pointer )
+
+    def restore(self, snapshot):
+        # Return to the state captured by snapshot(). Peripherals and input and output are not
+        # part of the snapshot.
+        self._page_data_array()
+        self._data_array.restore( snapshot.memory )
+        self._instruction_pointer = snapshot.instruction_pointer
+        self._shadow_instruction_pointer = snapshot.shadow_instruction_pointer
+        self._data_pointer = snapshot.data_pointer
+        self._shadow_data_pointer = snapshot.shadow_data_pointer
+
+    def _page_data_array(self):
+        # A flat data array can't tell which cells were written, so the first snapshot moves its
+        # contents onto a PagedMemory, which stays in place until the interpreter is discarded
+        if not isinstance(self._data_array, PagedMemory):
+            paged = PagedMemory( self._data_array_size, self._cell_width, self._page_size )
+            paged.load( self._data_array )
+            self._data_array = paged
+
+    def map_io(self, start, stop, read=None, write=None):
+        # Simulate a peripheral at cells start to stop - 1. Reads of those cells return
+        # read(address) and writes call write(address, value) instead of using the data array.
+        # Either handler may be None to leave that direction to the data array. Fused instructions
+        # merge, drop and reorder cell accesses, so while any peripheral is mapped the program
+        # runs unfused and a device sees every access the source makes.
+        if self._mapped is None:
+            self._mapped = MappedMemory( self._data_array, self._cell_mask )
+        self._mapped.memory = self._data_array
+        self._mapped.map( start, stop, read, write )
+        self._update_io()
+
+    def unmap_io(self, start):
+        # Remove the peripheral mapped at start. Without any, instructions are run without
+        # checking for mapped cells again.
+        if self._mapped is None:
+            raise ValueError( "No memory mapped region starts at {}".format(start) )
+        self._mapped.unmap( start )
+        if not self._mapped.regions:
+            self._mapped = None
+        self._update_io()
+
+    def _update_io(self):
+        # Recompute which instructions may access a mapped cell. The generated code embeds the
+        # mapped bounds, so it is generated again on the next run().
+        self._select_program( self._optimize and self._mapped is None )
+        if self._mapped is None:
+            self._io_guards = None
+        else:
+            self._io_guards = [ self._io_guard(opcode, mode, operand) for opcode, mode, operand in self._program ]
+        self._compiled = None
+        self._install_step()
+
+    def _io_guard(self, opcode, mode, operand):
+        # The data pointers for which an instruction may access a mapped cell: None if it never
+        # does, True if it always may, or a container to test the data pointer against. That is
+        # a range covering every offset the instruction accesses, or a _MultiplyGuard for multiply
+        # loops, whose targets wrap around the data array. Constant addresses are checked against
+        # the mapped bounds here.
+        offsets = []
+        addresses = []
+        if opcode in (OP_SWAP_DP, OP_SWAP_IP, OP_JUMP, OP_CALL, OP_EXTERN, OP_NOP, OP_LABEL, OP_MOVE):
+            return None
+        elif opcode == OP_SCAN:
+            return True
+        elif opcode == OP_MULTIPLY:
+            offsets = [0] + [ offset for offset, factor in operand ]
+        elif opcode in (OP_RIGHT, OP_LEFT):
+            # Only the '*' forms and ':' moves read a cell
+            if mode == MODE_MOVE_REL:
+                offsets = [operand]
+            elif mode in (MODE_AT_ABS, MODE_AT_REL_ABS, MODE_LIT_ABS, MODE_LIT_REL_ABS):
+                addresses = [operand]
+            else:
+                return None
+        elif mode == MODE_NONE:
+            offsets = [0]
+        elif mode == MODE_COND_LIT:
+            return None
+        elif mode in (MODE_AT_ABS, MODE_AT_REL_ABS, MODE_LIT_REL_ABS):
+            # The address is read from a cell
+            return True
+        else:
+            # Brackets with an '@' mode only test the addressed cell, everything else also
+            # accesses the current cell
+            if not (opcode in (OP_OPEN, OP_CLOSE) and mode < MODE_LIT):
+                offsets.append( 0 )
+            if mode in (MODE_AT, MODE_LIT_ABS):
+                addresses.append( operand )
+            elif mode in (MODE_AT_REL, MODE_LIT_REL):
+                offsets.append( operand )
+
+        # An operand of None is the shadow data pointer, which is only known at run time
+        if None in offsets or None in addresses:
+            return True
+        low, high = self._mapped.bounds
+        for address in addresses:
+            if low <= address < high:
+                return True
+        if not offsets:
+            return None
+        if opcode == OP_MULTIPLY:
+            return _MultiplyGuard( offsets, low, high, self._data_array_size )
+        return range( low - max(offsets), high - min(offsets) )
 
     def step(self):
         # run the current instruction and step the program
-        if self._instruction_pointer >= len(self._app.instructions):
+        if self._instruction_pointer >= len(self._program):
+            self.flush()
             return False
 
         if self._instruction_pointer < 0:
             raise ValueError( "Negative instruction pointer!" )
 
-        current_instruction = self._app.instructions[self._instruction_pointer]
+        opcode, mode, operand = self._program[self._instruction_pointer]
+
+        if operand is None:
+            operand = self._shadow_data_pointer
 
+        self._dispatch[opcode][mode]( operand )
+
+        self._instruction_pointer += 1
+        return True
+
+    def _install_step(self):
+        # step() itself never checks for debugging, profiling or mapped peripherals. Turning any
+        # of them on shadows it with an instance attribute, and turning all off removes the
+        # attribute again.
+        if self._profile:
+            self.step = self._profile_step
+        elif self._debug:
+            self.step = self._debug_step
+        elif self._mapped is not None:
+            self.step = self._mapped_step
+        else:
+            self.__dict__.pop( "step", None )
+        self._dispatch[OP_RIGHT][MODE_NONE] = self._right_checked if self._debug else self._right
+        self._dispatch[OP_LEFT][MODE_NONE] = self._left_checked if self._debug else self._left
+        self._dispatch[OP_MOVE][MODE_NONE] = self._move_checked if self._debug else self._move
+
+    def _debug_step(self):
+        if 0 <= self._instruction_pointer < len(self._program):
+            self._print_state()
+        return self._next_step()
+
+    def _next_step(self):
+        # step() without debugging and profiling
+        if self._mapped is not None:
+            return self._mapped_step()
+        return Interpreter.step( self )
+
+    def _mapped_step(self):
+        # step() while peripherals are mapped. Only instructions that may access a mapped cell run
+        # against the memory map, all others index the data array directly.
+        ip = self._instruction_pointer
+        if not 0 <= ip < len(self._program):
+            return Interpreter.step( self )
+        guard = self._io_guards[ip]
+        if guard is not None and (guard is True or self._data_pointer in guard):
+            return self._step_mapped()
+
+        opcode, mode, operand = self._program[ip]
+        if operand is None:
+            operand = self._shadow_data_pointer
+        self._dispatch[opcode][mode]( operand )
+        self._instruction_pointer += 1
+        return True
+
+    def _step_mapped(self):
+        # step() with the memory map in place of the data array
+        memory = self._data_array
+        self._mapped.memory = memory
+        self._data_array = self._mapped
+        try:
+            return Interpreter.step( self )
+        finally:
+            self._data_array = memory
+
+    def _run_mapped(self, index, dp, sdp):
+        # Run the instruction at index against the memory map for the function translate()
+        # generates, which keeps the data pointers in locals
+        self._instruction_pointer = index
+        self._data_pointer = dp
+        self._shadow_data_pointer = sdp
+        self._step_mapped()
+        return self._data_pointer, self._shadow_data_pointer
+
+    def _branch_mapped(self, index, dp, sdp):
+        # Whether the bracket at index jumps, run against the memory map
+        self._run_mapped( index, dp, sdp )
+        return self._instruction_pointer != index + 1
+
+    def _profile_step(self):
+        ip = self._instruction_pointer
+        if not 0 <= ip < len(self._program):
+            return self._next_step()
         if self._debug:
-            print( "Instruction[{}]:  {}".format(self._instruction_pointer,current_instruction) )
-            print( "Data Array:       {}".format([ str(x).zfill(3) for x in self._data_array[max(self._data_pointer-5,0):max(11,min(self._data_pointer+6,len(self._data_array)-1))] ]) )
-            print( "Current Cell:     {}^{}".format( '    ' + ' '*7*min( 5, self._data_pointer ), str(self._data_pointer) ) )
-            print( "Shadow Registers:" )
-            print( "  Instruction:    {}".format(self._shadow_instruction_pointer) )
-            print( "  Data:           {}".format(self._shadow_data_pointer) )
-            if self._debug >= 2:
-                empty = raw_input( "Press Return To Continue" )
-
-        if current_instruction == '>':
-            # Move data pointer right one
-            self._data_pointer = (self._data_pointer + 1) % len(self._data_array)
-            if self._debug >= 1:
-                if self._data_pointer == 0:
-                    print( "Overran data array!" )
-                    empty = raw_input( "Press enter to continue" )
-
-
-        elif current_instruction == '<':
-            # Move data pointer left one
-            self._data_pointer = (self._data_pointer - 1) % len(self._data_array)
-            if self._debug >= 1:
-                if self._data_pointer == (len(self._data_array) - 1):
-                    print( "Underran data array!" )
-                    empty = raw_input( "Press enter to continue" )
-
-        elif current_instruction == '+':
-            # Increment current data value
-            self._data_array[self._data_pointer] = (self._data_array[self._data_pointer] + 1) % 256
-
-        elif current_instruction == '-':
-            # Decrement current data value
-            self._data_array[self._data_pointer] = (self._data_array[self._data_pointer] - 1) % 256
-
-        elif current_instruction == '.':
-            # Output the current data value to _stdout
-            self._stdout.write( chr(self._data_array[self._data_pointer]) )
-
-        elif current_instruction == ',':
-            # Input a value from _stdin
-            self._data_array[self._data_pointer] = ord(self._stdin.read( 1 ))
-
-        elif current_instruction == '[':
-            if self._data_array[self._data_pointer] == 0:
-                self._instruction_pointer = self.find_matching_bracket( self._instruction_pointer )
-
-        elif current_instruction == ']':
-            if self._data_array[self._data_pointer] != 0:
-                self._instruction_pointer = self.find_matching_bracket( self._instruction_pointer )
-
-        elif current_instruction == '~':
-            self._data_array[self._data_pointer] = (~self._data_array[self._data_pointer]) & 0xFF
-
-        elif current_instruction == '%':
-            temp = self._data_pointer
-            self._data_pointer = self._shadow_data_pointer
-            self._shadow_data_pointer = temp
-
-        elif current_instruction == '!':
-            temp = self._instruction_pointer
-            self._instruction_pointer = self._shadow_instruction_pointer
-            self._shadow_instruction_pointer = temp
-
-        elif re.match( "\(([\>\<\+\-\.\,\[\]\&\|\^\\\/])([\@\#]\:?\*?)(.*)\)", current_instruction ) is not None:
-            match = re.match( "\(([\>\<\+\-\.\,\[\]\&\|\^\\\/])([\@\#]\:?\*?)(.*)\)", current_instruction )
-
-            instruction = match.group(1)
-            modifiers = match.group(2)
-            if match.group(3) == '%':
-                value = self._shadow_data_pointer
-            else:
-                value = int(match.group(3),0)
-
-            if instruction == '>':
-                if modifiers == '@':
-                    self._data_pointer = value # todo: bounds check
-                elif modifiers == '@*':
-                    self._data_pointer = self._data_array[ value ]
-                elif modifiers == '@:':
-                    self._data_pointer += value
-                elif modifiers == '@:*':
-                    self._data_pointer += self._data_array[ value ]
-                elif modifiers == '#':
-                    self._data_pointer = value # todo: bounds check
-                elif modifiers == '#*':
-                    self._data_pointer = self._data_array[ value ]
-                elif modifiers == '#:':
-                    self._data_pointer += value
-                elif modifiers == '#:*':
-                    self._data_pointer += self._data_array[ value ]
-                else:
-                    raise SyntaxError("Unexpected modifiers in {}: {}".format(current_instruction, self._instruction_pointer))
-
-            elif instruction == '<':
-                if modifiers == '@':
-                    self._data_pointer = value # todo: bounds check
-                elif modifiers == '@*':
-                    self._data_pointer = self._data_array[ value ]
-                elif modifiers == '@:':
-                    self._data_pointer -= value
-                elif modifiers == '@:*':
-                    self._data_pointer -= self._data_array[ value ]
-                elif modifiers == '#':
-                    self._data_pointer = value # todo: bounds check
-                elif modifiers == '#*':
-                    self._data_pointer = self._data_array[ value ]
-                elif modifiers == '#:':
-                    self._data_pointer -= value
-                elif modifiers == '#:*':
-                    self._data_pointer -= self._data_array[ value ]
-                else:
-                    raise SyntaxError("Unexpected modifiers in {}: {}".format(current_instruction, self._instruction_pointer))
-
-            elif instruction == '+':
-                if modifiers == '@':
-                    self._data_array[value] = (self._data_array[value] + 1) % 256
-                elif modifiers == '@*':
-                    self._data_array[self._data_array[value]] = (self._data_array[self._data_array[value]] + 1) % 256
-                elif modifiers == '@:':
-                    self._data_array[self._data_pointer + value] = (self._data_array[self._data_pointer + value] + 1) % 256
-                elif modifiers == '@:*':
-                    self._data_array[self._data_array[self._data_pointer + value]] = (self._data_array[self._data_array[self._data_pointer + value]] + 1) % 256
-                elif modifiers == '#':
-                    self._data_array[self._data_pointer] = (self._data_array[self._data_pointer] + value) % 256
-                elif modifiers == '#*':
-                    self._data_array[self._data_pointer] = (self._data_array[self._data_pointer] + self._data_array[value]) % 256
-                elif modifiers == '#:':
-                    self._data_array[self._data_pointer] = (self._data_array[self._data_pointer] + self._data_array[self._data_pointer + value]) % 256
-                elif modifiers == '#:*':
-                    self._data_array[self._data_pointer] = (self._data_array[self._data_pointer] + self._data_array[self._data_array[self._data_pointer + value]]) % 256
-                else:
-                    raise SyntaxError("Unexpected modifiers in {}: {}".format(current_instruction, self._instruction_pointer))
-
-            elif instruction == '-':
-                if modifiers == '@':
-                    self._data_array[value] = (self._data_array[value] - 1) % 256
-                elif modifiers == '@*':
-                    self._data_array[self._data_array[value]] = (self._data_array[self._data_array[value]] - 1) % 256
-                elif modifiers == '@:':
-                    self._data_array[self._data_pointer + value] = (self._data_array[self._data_pointer + value] - 1) % 256
-                elif modifiers == '@:*':
-                    self._data_array[self._data_array[self._data_pointer + value]] = (self._data_array[self._data_array[self._data_pointer + value]] - 1) % 256
-                elif modifiers == '#':
-                    self._data_array[self._data_pointer] = (self._data_array[self._data_pointer] - value) % 256
-                elif modifiers == '#*':
-                    self._data_array[self._data_pointer] = (self._data_array[self._data_pointer] - self._data_array[value]) % 256
-                elif modifiers == '#:':
-                    self._data_array[self._data_pointer] = (self._data_array[self._data_pointer] - self._data_array[self._data_pointer + value]) % 256
-                elif modifiers == '#:*':
-                    self._data_array[self._data_pointer] = (self._data_array[self._data_pointer] - self._data_array[self._data_array[self._data_pointer + value]]) % 256
-                else:
-                    raise SyntaxError("Unexpected modifiers in {}: {}".format(current_instruction, self._instruction_pointer))
-
-            elif instruction == '.':
-                if modifiers == '@':
-                    self._data_array[value] = self._data_array[self._data_pointer]
-                elif modifiers == '@*':
-                    self._data_array[self._data_array[value]] = self._data_array[self._data_pointer]
-                elif modifiers == '@:':
-                    self._data_array[self._data_pointer + value] = self._data_array[self._data_pointer]
-                elif modifiers == '@:*':
-                    self._data_array[self._data_array[self._data_pointer + value]] = self._data_array[self._data_pointer]
-                elif modifiers == '#':
-                    self._stdout.write( chr(value) )
-                elif modifiers == '#*':
-                    self._stdout.write( chr(self._data_array[value]) )
-                elif modifiers == '#:':
-                    self._stdout.write( chr(self._data_array[self._data_pointer + value]) )
-                elif modifiers == '#:*':
-                    self._stdout.write( chr(self._data_array[self._data_array[self._data_pointer + value]]) )
-                else:
-                    raise SyntaxError("Unexpected modifiers in {}: {}".format(current_instruction, self._instruction_pointer))
-
-            elif instruction == ',':
-                if modifiers == '@':
-                    self._data_array[value] = self._stdin.read(1)
-                elif modifiers == '@*':
-                    self._data_array[self._data_array[value]] = self._stdin.read(1)
-                elif modifiers == '@:':
-                    self._data_array[self._data_pointer + value] = self._stdin.read(1)
-                elif modifiers == '@:*':
-                    self._data_array[self._data_array[self._data_pointer + value]] = self._stdin.read(1)
-                elif modifiers == '#':
-                    self._data_array[self._data_pointer] = value
-                elif modifiers == '#*':
-                    self._data_array[self._data_pointer] = self._data_array[value]
-                elif modifiers == '#:':
-                    self._data_array[self._data_pointer] = self._data_array[self._data_pointer + value]
-                elif modifiers == '#:*':
-                    self._data_array[self._data_pointer] = self._data_array[self._data_array[self._data_pointer + value]]
-                else:
-                    raise SyntaxError("Unexpected modifiers in {}: {}".format(current_instruction, self._instruction_pointer))
-
-            elif instruction == '[':
-                if modifiers == '@':
-                    if self._data_array[value] == 0:
-                        self._instruction_pointer = self.find_matching_bracket( self._instruction_pointer )
-                elif modifiers == '@*':
-                    if self._data_array[self._data_array[value]] == 0:
-                        self._instruction_pointer = self.find_matching_bracket( self._instruction_pointer )
-                elif modifiers == '@:':
-                    if self._data_array[self._data_pointer + value] == 0:
-                        self._instruction_pointer = self.find_matching_bracket( self._instruction_pointer )
-                elif modifiers == '@:*':
-                    if self._data_array[self._data_array[self._data_pointer + value]] == 0:
-                        self._instruction_pointer = self.find_matching_bracket( self._instruction_pointer )
-                elif modifiers == '#':
-                    if self._data_array[self._data_pointer] == value:
-                        self._instruction_pointer = self.find_matching_bracket( self._instruction_pointer )
-                elif modifiers == '#*':
-                    if self._data_array[self._data_pointer] == self._data_array[value]:
-                        self._instruction_pointer = self.find_matching_bracket( self._instruction_pointer )
-                elif modifiers == '#:':
-                    if self._data_array[self._data_pointer] == self._data_array[self._data_pointer + value]:
-                        self._instruction_pointer = self.find_matching_bracket( self._instruction_pointer )
-                elif modifiers == '#:*':
-                    if self._data_array[self._data_pointer] == self._data_array[self._data_array[self._data_pointer + value]]:
-                        self._instruction_pointer = self.find_matching_bracket( self._instruction_pointer )
-                else:
-                    raise SyntaxError("Unexpected modifiers in {}: {}".format(current_instruction, self._instruction_pointer))
-
-            elif instruction == ']':
-                if modifiers == '@':
-                    if self._data_array[value] != 0:
-                        self._instruction_pointer = self.find_matching_bracket( self._instruction_pointer )
-                elif modifiers == '@*':
-                    if self._data_array[self._data_array[value]] != 0:
-                        self._instruction_pointer = self.find_matching_bracket( self._instruction_pointer )
-                elif modifiers == '@:':
-                    if self._data_array[self._data_pointer + value] != 0:
-                        self._instruction_pointer = self.find_matching_bracket( self._instruction_pointer )
-                elif modifiers == '@:*':
-                    if self._data_array[self._data_array[self._data_pointer + value]] != 0:
-                        self._instruction_pointer = self.find_matching_bracket( self._instruction_pointer )
-                elif modifiers == '#':
-                    if self._data_array[self._data_pointer] != value:
-                        self._instruction_pointer = self.find_matching_bracket( self._instruction_pointer )
-                elif modifiers == '#*':
-                    if self._data_array[self._data_pointer] != self._data_array[value]:
-                        self._instruction_pointer = self.find_matching_bracket( self._instruction_pointer )
-                elif modifiers == '#:':
-                    if self._data_array[self._data_pointer] != self._data_array[self._data_pointer + value]:
-                        self._instruction_pointer = self.find_matching_bracket( self._instruction_pointer )
-                elif modifiers == '#:*':
-                    if self._data_array[self._data_pointer] != self._data_array[self._data_array[self._data_pointer + value]]:
-                        self._instruction_pointer = self.find_matching_bracket( self._instruction_pointer )
-                else:
-                    raise SyntaxError("Unexpected modifiers in {}: {}".format(current_instruction, self._instruction_pointer))
-
-            elif instruction == '&':
-                if modifiers == '@':
-                    self._data_array[value] = (self._data_array[value] & self._data_array[self._data_pointer]) & 0xFF
-                elif modifiers == '@*':
-                    self._data_array[self._data_array[value]] = (self._data_array[self._data_array[value]] & self._data_array[self._data_pointer]) & 0xFF
-                elif modifiers == '@:':
-                    self._data_array[self._data_pointer + value] = (self._data_array[self._data_pointer + value] & self._data_array[self._data_pointer]) & 0xFF
-                elif modifiers == '@:*':
-                    self._data_array[self._data_array[self._data_pointer + value]] = (self._data_array[self._data_array[self._data_pointer + value]] & self._data_array[self._data_pointer]) & 0xFF
-                elif modifiers == '#':
-                    self._data_array[self._data_pointer] = (self._data_array[self._data_pointer] & value) & 0xFF
-                elif modifiers == '#*':
-                    self._data_array[self._data_pointer] = (self._data_array[self._data_pointer] & self._data_array[value]) & 0xFF
-                elif modifiers == '#:':
-                    self._data_array[self._data_pointer] = (self._data_array[self._data_pointer] & self._data_array[self._data_pointer + value]) & 0xFF
-                elif modifiers == '#:*':
-                    self._data_array[self._data_pointer] = (self._data_array[self._data_pointer] & self._data_array[self._data_array[self._data_pointer + value]]) & 0xFF
-                else:
-                    raise SyntaxError("Unexpected modifiers in {}: {}".format(current_instruction, self._instruction_pointer))
-
-            elif instruction == '|':
-                if modifiers == '@':
-                    self._data_array[value] = (self._data_array[value] | self._data_array[self._data_pointer]) & 0xFF
-                elif modifiers == '@*':
-                    self._data_array[self._data_array[value]] = (self._data_array[self._data_array[value]] | self._data_array[self._data_pointer]) & 0xFF
-                elif modifiers == '@:':
-                    self._data_array[self._data_pointer + value] = (self._data_array[self._data_pointer + value] | self._data_array[self._data_pointer]) & 0xFF
-                elif modifiers == '@:*':
-                    self._data_array[self._data_array[self._data_pointer + value]] = (self._data_array[self._data_array[self._data_pointer + value]] | self._data_array[self._data_pointer]) & 0xFF
-                elif modifiers == '#':
-                    self._data_array[self._data_pointer] = (self._data_array[self._data_pointer] | value) & 0xFF
-                elif modifiers == '#*':
-                    self._data_array[self._data_pointer] = (self._data_array[self._data_pointer] | self._data_array[value]) & 0xFF
-                elif modifiers == '#:':
-                    self._data_array[self._data_pointer] = (self._data_array[self._data_pointer] | self._data_array[self._data_pointer + value]) & 0xFF
-                elif modifiers == '#:*':
-                    self._data_array[self._data_pointer] = (self._data_array[self._data_pointer] | self._data_array[self._data_array[self._data_pointer + value]]) & 0xFF
-                else:
-                    raise SyntaxError("Unexpected modifiers in {}: {}".format(current_instruction, self._instruction_pointer))
-
-            elif instruction == '^':
-                if modifiers == '@':
-                    self._data_array[value] = (self._data_array[value] ^ self._data_array[self._data_pointer]) & 0xFF
-                elif modifiers == '@*':
-                    self._data_array[self._data_array[value]] = (self._data_array[self._data_array[value]] ^ self._data_array[self._data_pointer]) & 0xFF
-                elif modifiers == '@:':
-                    self._data_array[self._data_pointer + value] = (self._data_array[self._data_pointer + value] ^ self._data_array[self._data_pointer]) & 0xFF
-                elif modifiers == '@:*':
-                    self._data_array[self._data_array[self._data_pointer + value]] = (self._data_array[self._data_array[self._data_pointer + value]] ^ self._data_array[self._data_pointer]) & 0xFF
-                elif modifiers == '#':
-                    self._data_array[self._data_pointer] = (self._data_array[self._data_pointer] ^ value) & 0xFF
-                elif modifiers == '#*':
-                    self._data_array[self._data_pointer] = (self._data_array[self._data_pointer] ^ self._data_array[value]) & 0xFF
-                elif modifiers == '#:':
-                    self._data_array[self._data_pointer] = (self._data_array[self._data_pointer] ^ self._data_array[self._data_pointer + value]) & 0xFF
-                elif modifiers == '#:*':
-                    self._data_array[self._data_pointer] = (self._data_array[self._data_pointer] ^ self._data_array[self._data_array[self._data_pointer + value]]) & 0xFF
-                else:
-                    raise SyntaxError("Unexpected modifiers in {}: {}".format(current_instruction, self._instruction_pointer))
-
-            elif instruction == '/':
-                if modifiers == '@':
-                    self._data_array[value] = (self._data_array[value] >> self._data_array[self._data_pointer]) & 0xFF
-                elif modifiers == '@*':
-                    self._data_array[self._data_array[value]] = (self._data_array[self._data_array[value]] >> self._data_array[self._data_pointer]) & 0xFF
-                elif modifiers == '@:':
-                    self._data_array[self._data_pointer + value] = (self._data_array[self._data_pointer + value] >> self._data_array[self._data_pointer]) & 0xFF
-                elif modifiers == '@:*':
-                    self._data_array[self._data_array[self._data_pointer + value]] = (self._data_array[self._data_array[self._data_pointer + value]] >> self._data_array[self._data_pointer]) & 0xFF
-                elif modifiers == '#':
-                    self._data_array[self._data_pointer] = (self._data_array[self._data_pointer] >> value) & 0xFF
-                elif modifiers == '#*':
-                    self._data_array[self._data_pointer] = (self._data_array[self._data_pointer] >> self._data_array[value]) & 0xFF
-                elif modifiers == '#:':
-                    self._data_array[self._data_pointer] = (self._data_array[self._data_pointer] >> self._data_array[self._data_pointer + value]) & 0xFF
-                elif modifiers == '#:*':
-                    self._data_array[self._data_pointer] = (self._data_array[self._data_pointer] >> self._data_array[self._data_array[self._data_pointer + value]]) & 0xFF
+            self._print_state()
+
+        self._instruction_counts[ip] += 1
+        opcode = self._program[ip][0]
+        stepped = self._next_step()
+        # A loop iterates when '[' falls through into the body or ']' jumps back to the start
+        if opcode == OP_OPEN and self._instruction_pointer == ip + 1:
+            self._loop_counts[ip] += 1
+        elif opcode == OP_CLOSE and self._instruction_pointer != ip + 1:
+            self._loop_counts[self._jump_table[ip]] += 1
+        return stepped
+
+    def _print_state(self):
+        self.flush()
+        print( "Instruction[{}]:  {}".format(self._instruction_pointer,self._app.instructions[self._source_map[self._instruction_pointer]]) )
+        print( "Data Array:       {}".format([ str(x).zfill(3) for x in self._data_array[max(self._data_pointer-5,0):max(11,min(self._data_pointer+6,len(self._data_array)-1))] ]) )
+        print( "Current Cell:     {}^{}".format( '    ' + ' '*7*min( 5, self._data_pointer ), str(self._data_pointer) ) )
+        print( "Shadow Registers:" )
+        print( "  Instruction:    {}".format(self._shadow_instruction_pointer) )
+        print( "  Data:           {}".format(self._shadow_data_pointer) )
+        if self._debug >= 2:
+            empty = input( "Press Return To Continue" )
+
+    def source_location(self, index):
+        # Description of where decoded instruction index came from: "line:column instruction" for
+        # source parsed by the front end, the instruction index otherwise
+        instruction = self._app.instructions[self._source_map[index]]
+        if isinstance(instruction, tuple):
+            return "{}:{} {}".format( instruction.line, instruction.column,
+                                      instruction.op + instruction.mode + str(instruction.operand) + instruction.label )
+        return "{} {}".format( self._source_map[index], instruction )
+
+    def profile_report(self, limit=10):
+        # The most executed instructions and most iterated loops, with their source locations
+        if self._instruction_counts is None:
+            raise ValueError( "Profiling is not enabled" )
+        lines = [ "Instructions: {}".format(sum(self._instruction_counts)) ]
+        hot = sorted( range(len(self._program)), key=lambda index: -self._instruction_counts[index] )
+        for index in hot[:limit]:
+            if self._instruction_counts[index] == 0:
+                break
+            lines.append( "  {:>12}  {}".format(self._instruction_counts[index], self.source_location(index)) )
+
+        loops = [ index for index in range(len(self._program)) if self._loop_counts[index] ]
+        lines.append( "Loops: {}".format(len(loops)) )
+        loops.sort( key=lambda index: -self._loop_counts[index] )
+        for index in loops[:limit]:
+            lines.append( "  {:>12}  {} (entered {} times)".format(
+                self._loop_counts[index], self.source_location(index), self._instruction_counts[index]) )
+        return "\n".join( lines )
+
+    def run(self):
+        # Run the program to completion. Programs with structured control flow are translated
+        # into a native Python function on first use; anything else, and debug and profiling
+        # sessions, fall back to stepping.
+        try:
+            if self._debug or self._profile or self._instruction_pointer != 0:
+                while self.step():
+                    pass
+                return
+
+            if self._compiled is None:
+                self._compiled = self.translate()
+            if self._compiled is False:
+                while self.step():
+                    pass
+                return
+
+            self._data_pointer, self._shadow_data_pointer = self._compiled(
+                self._data_array, self._data_pointer, self._shadow_data_pointer, self._read_input,
+                self._output_buffer, self.flush )
+            self._instruction_pointer = len(self._program)
+        finally:
+            self.flush()
+
+    def flush(self):
+        # Write the gathered output to stdout. Each byte is written as the character with that
+        # code, the same as chr() of the cell.
+        if self._output_buffer:
+            text = self._output_buffer.decode( "latin-1" )
+            del self._output_buffer[:]
+            self._stdout.write( text )
+
+    def _put(self, value):
+        # Output the low byte of value, as the generated C does
+        self._output_buffer.append( value & 0xFF )
+        if len(self._output_buffer) >= self._output_chunk:
+            self.flush()
+
+    def _read_input(self):
+        # Next input byte
+        if self._input_position >= len(self._input_buffer):
+            self._fill_input()
+            if self._input_position >= len(self._input_buffer):
+                if self._eof is None:
+                    raise EOFError( "End of input: {}".format(self._instruction_pointer) )
+                return self._eof & self._cell_mask
+        value = self._input_buffer[self._input_position]
+        self._input_position += 1
+        return value
+
+    def _fill_input(self):
+        # Read the next block of stdin into the input buffer
+        if self._stdin is None:
+            return
+        # Flush first so prompts are shown before waiting for input
+        self.flush()
+        stream = getattr( self._stdin, "buffer", self._stdin )
+        # read1() returns what is available instead of waiting for a full block
+        read = getattr( stream, "read1", stream.read )
+        data = read( self._input_chunk )
+        if not isinstance(data, (bytes, bytearray)):
+            data = [ ord(c) for c in data ]
+        self._input_buffer = data
+        self._input_position = 0
+
+    def translate(self):
+        # Generate and compile a Python function equivalent to the decoded program, or return
+        # False if the program cannot be expressed with structured loops. While peripherals are
+        # mapped, instructions that may access a mapped cell check the mapped bounds first and
+        # run against the memory map when they hit them.
+        lines = [ "def program(data, dp, sdp, read, out, flush):",
+                  "    size = len(data)",
+                  "    mask = {}".format(self._cell_mask),
+                  "    chunk = {}".format(self._output_chunk) ]
+        indent = 1
+        for index, (opcode, mode, operand) in enumerate(self._program):
+            if opcode in (OP_SWAP_IP, OP_JUMP, OP_CALL, OP_EXTERN):
+                return False
+            value = "sdp" if operand is None else repr(operand)
+            if opcode == OP_OPEN:
+                if self._plain_loop( index ):
+                    guard = self._translate_guard( index )
+                    if guard is None:
+                        lines.append( "    " * indent + "while data[dp]:" )
+                    else:
+                        # Both brackets test the current cell, so the loop repeats while its '['
+                        # would not skip it
+                        lines.append( "    " * indent + "while not branch_mapped({}, dp, sdp) if {} else data[dp]:".format(index, guard) )
+                    indent += 1
                 else:
-                    raise SyntaxError("Unexpected modifiers in {}: {}".format(current_instruction, self._instruction_pointer))
-
-            elif instruction == '\\':
-                if modifiers == '@':
-                    self._data_array[value] = (self._data_array[value] << self._data_array[self._data_pointer]) & 0xFF
-                elif modifiers == '@*':
-                    self._data_array[self._data_array[value]] = (self._data_array[self._data_array[value]] << self._data_array[self._data_pointer]) & 0xFF
-                elif modifiers == '@:':
-                    self._data_array[self._data_pointer + value] = (self._data_array[self._data_pointer + value] << self._data_array[self._data_pointer]) & 0xFF
-                elif modifiers == '@:*':
-                    self._data_array[self._data_array[self._data_pointer + value]] = (self._data_array[self._data_array[self._data_pointer + value]] << self._data_array[self._data_pointer]) & 0xFF
-                elif modifiers == '#':
-                    self._data_array[self._data_pointer] = (self._data_array[self._data_pointer] << value) & 0xFF
-                elif modifiers == '#*':
-                    self._data_array[self._data_pointer] = (self._data_array[self._data_pointer] << self._data_array[value]) & 0xFF
-                elif modifiers == '#:':
-                    self._data_array[self._data_pointer] = (self._data_array[self._data_pointer] << self._data_array[self._data_pointer + value]) & 0xFF
-                elif modifiers == '#:*':
-                    self._data_array[self._data_pointer] = (self._data_array[self._data_pointer] << self._data_array[self._data_array[self._data_pointer + value]]) & 0xFF
+                    skip = self._translate_mapped_condition( index, self._translate_condition(opcode, mode, value) )
+                    lines.append( "    " * indent + "if not ({}):".format(skip) )
+                    lines.append( "    " * (indent + 1) + "while True:" )
+                    indent += 2
+                lines.append( "    " * indent + "pass" )
+            elif opcode == OP_CLOSE:
+                if self._plain_loop( self._jump_table[index] ):
+                    indent -= 1
                 else:
-                    raise SyntaxError("Unexpected modifiers in {}: {}".format(current_instruction, self._instruction_pointer))
+                    repeat = self._translate_mapped_condition( index, self._translate_condition(opcode, mode, value) )
+                    lines.append( "    " * indent + "if not ({}):".format(repeat) )
+                    lines.append( "    " * (indent + 1) + "break" )
+                    indent -= 2
             else:
-                raise SyntaxError("Unknown absolute addressed instruction: {}: {}".format(self._instruction_pointer,current_instruction))
-
-        elif re.match( "\(\!(\:?)([a-zA-Z][a-zA-Z0-9]*)\)", current_instruction ) is not None:
-            match = re.match( "\(\!(\:?)([a-zA-Z][a-zA-Z0-9]*)\)", current_instruction )
-            identifier = match.group(2)
-            if match.group(1) == ':':
-                self._shadow_instruction_pointer = self._instruction_pointer
-            # todo: Catch KeyError in case of undefined identifier
-            self._instruction_pointer = self._identifier_dict[ identifier ] - 1 # back one to account for later step of instruction pointer
-            if self._debug >= 2:
-                print( "Jumping from {} to {}.".format( self._instruction_pointer, self._identifier_dict[ identifier ] ) )
+                statements = self._translate_instruction( opcode, mode, operand, value, index )
+                for line in self._translate_mapped( index, statements ):
+                    lines.append( "    " * indent + line )
+        lines.append( "    return dp, sdp" )
 
-        else:
-            raise SyntaxError("Unknown instruction: {}: {}".format(self._instruction_pointer,current_instruction))
+        namespace = { "find_zero": find_zero, "run_mapped": self._run_mapped,
+                      "branch_mapped": self._branch_mapped }
+        try:
+            exec( compile( "\n".join(lines), "<ebf>", "exec" ), namespace )
+        except (SyntaxError, RuntimeError, MemoryError):
+            # Too deeply nested for the Python compiler
+            return False
+        return namespace["program"]
 
-        self._instruction_pointer += 1
-        return True
\ No newline at end of file
+    def _plain_loop(self, index):
+        # True if the '[' at index and its ']' are both unmodified, i.e. a plain while loop
+        return ( self._program[index][1] == MODE_NONE and
+                 self._program[self._jump_table[index]][1] == MODE_NONE )
+
+    def _translate_guard(self, index):
+        # Python expression for whether the instruction at index accesses a mapped cell, or None
+        # if it never does
+        guard = self._io_guards[index] if self._io_guards is not None else None
+        if guard is None:
+            return None
+        if guard is True:
+            return "True"
+        if isinstance(guard, _MultiplyGuard):
+            return guard.expression( "dp" )
+        return "{} <= dp < {}".format( guard.start, guard.stop )
+
+    def _translate_mapped(self, index, statements):
+        # statements for the instruction at index, running it against the memory map instead
+        # when it accesses a mapped cell
+        guard = self._translate_guard( index )
+        if guard is None:
+            return statements
+        mapped = "dp, sdp = run_mapped({}, dp, sdp)".format(index)
+        if guard == "True":
+            return [ mapped ]
+        return ( [ "if {}:".format(guard), "    " + mapped, "else:" ] +
+                 [ "    " + line for line in statements ] )
+
+    def _translate_mapped_condition(self, index, condition):
+        # condition for the bracket at index, evaluated against the memory map instead when it
+        # tests a mapped cell
+        guard = self._translate_guard( index )
+        if guard is None:
+            return condition
+        mapped = "branch_mapped({}, dp, sdp)".format(index)
+        if guard == "True":
+            return mapped
+        return "{} if {} else {}".format( mapped, guard, condition )
+
+    @staticmethod
+    def _translate_condition(opcode, mode, value):
+        # Python expression for when a bracket jumps
+        if mode == MODE_NONE:
+            return "data[dp] == 0" if opcode == OP_OPEN else "data[dp] != 0"
+        if mode == MODE_COND_LIT:
+            return "{} {} 0".format( value, "==" if opcode == OP_OPEN else "!=" )
+        compare = "==" if opcode == OP_OPEN else "!="
+        if mode < MODE_LIT:
+            return "data[{}] {} 0".format( _ADDRESS_EXPRESSIONS[mode].format(value), compare )
+        return "data[dp] {} {}".format( compare, _SOURCE_EXPRESSIONS[mode].format(value) )
+
+    @staticmethod
+    def _translate_instruction(opcode, mode, operand, value, index):
+        # Python statements equivalent to a single non-bracket instruction
+        if opcode == OP_ADD:
+            return [ "data[dp] = (data[dp] + {}) & mask".format(value) ]
+        if opcode == OP_MOVE:
+            return [ "dp = (dp + {}) % size".format(value) ]
+        if opcode == OP_CLEAR:
+            return [ "data[dp] = 0" ]
+        if opcode == OP_SCAN:
+            return [ "if data[dp]:",
+                     "    dp = find_zero(data, dp, {})".format(value),
+                     "    if dp < 0:",
+                     "        raise RuntimeError('Scan loop never finds a zero cell: {}')".format(index) ]
+        if opcode == OP_MULTIPLY:
+            lines = [ "if data[dp]:",
+                      "    value = data[dp]" ]
+            for offset, factor in operand:
+                lines.append( "    target = (dp + {}) % size".format(offset) )
+                lines.append( "    data[target] = (data[target] + value * {}) & mask".format(factor) )
+            lines.append( "    data[dp] = 0" )
+            lines.append( "    dp %= size" )
+            return lines
+        if opcode in (OP_NOP, OP_LABEL):
+            return []
+        if opcode == OP_NOT and mode == MODE_NONE:
+            return [ "data[dp] = (~data[dp]) & mask" ]
+        if opcode == OP_SWAP_DP:
+            return [ "dp, sdp = sdp, dp" ]
+
+        if opcode in (OP_RIGHT, OP_LEFT):
+            if mode == MODE_NONE:
+                return [ "dp = (dp {} 1) % size".format("+" if opcode == OP_RIGHT else "-") ]
+            if mode == MODE_MOVE_REL:
+                return [ "dp {}= data[dp + {}]".format("+" if opcode == OP_RIGHT else "-", value) ]
+            return [ _MOVE_STATEMENTS[opcode][(mode - MODE_AT) % 4].format(value) ]
+
+        if mode == MODE_NONE:
+            if opcode == OP_OUTPUT:
+                return [ "out.append(data[dp] & 255)",
+                         "if len(out) >= chunk:",
+                         "    flush()" ]
+            return [ "data[dp] = " + _STORE_OPERATIONS[opcode].format("data[dp]", "") ]
+
+        if mode < MODE_LIT:
+            # Store into the addressed cell
+            return [ "target = " + _ADDRESS_EXPRESSIONS[mode].format(value),
+                     "data[target] = " + _STORE_OPERATIONS[opcode].format("data[target]", "data[dp]") ]
+
+        # Update the current cell from the operand
+        source = _SOURCE_EXPRESSIONS[mode].format(value)
+        if opcode == OP_OUTPUT:
+            return [ "out.append({} & 255)".format(source),
+                     "if len(out) >= chunk:",
+                     "    flush()" ]
+        return [ "data[dp] = " + _UPDATE_OPERATIONS[opcode].format("data[dp]", source) ]
+
+    def _build_dispatch(self):
+        # Build the dispatch table indexed by [opcode][mode]. Unsupported combinations are
+        # rejected by decode(), so their slots are left empty.
+        dispatch = [ [None] * MODE_COUNT for _ in range(OP_COUNT) ]
+        mask = self._cell_mask
+
+        dispatch[OP_RIGHT][MODE_NONE] = self._right
+        dispatch[OP_LEFT][MODE_NONE] = self._left
+        dispatch[OP_INC][MODE_NONE] = self._inc
+        dispatch[OP_DEC][MODE_NONE] = self._dec
+        dispatch[OP_OUTPUT][MODE_NONE] = self._output
+        dispatch[OP_INPUT][MODE_NONE] = self._input
+        dispatch[OP_OPEN][MODE_NONE] = self._open
+        dispatch[OP_CLOSE][MODE_NONE] = self._close
+        dispatch[OP_NOT][MODE_NONE] = self._not
+        dispatch[OP_SWAP_DP][MODE_NONE] = self._swap_dp
+        dispatch[OP_SWAP_IP][MODE_NONE] = self._swap_ip
+        dispatch[OP_JUMP][MODE_NONE] = self._jump
+        dispatch[OP_CALL][MODE_NONE] = self._call
+        dispatch[OP_ADD][MODE_NONE] = self._add
+        dispatch[OP_MOVE][MODE_NONE] = self._move
+        dispatch[OP_CLEAR][MODE_NONE] = self._clear
+        dispatch[OP_SCAN][MODE_NONE] = self._scan
+        dispatch[OP_MULTIPLY][MODE_NONE] = self._multiply
+        dispatch[OP_NOP][MODE_NONE] = self._nop
+        dispatch[OP_LABEL][MODE_NONE] = self._nop
+        dispatch[OP_EXTERN][MODE_NONE] = self._extern
+        dispatch[OP_RIGHT][MODE_MOVE_REL] = self._add_dp_rel
+        dispatch[OP_LEFT][MODE_MOVE_REL] = self._sub_dp_rel
+        dispatch[OP_OPEN][MODE_COND_LIT] = self._make_branch( lambda value: value == 0 )
+        dispatch[OP_CLOSE][MODE_COND_LIT] = self._make_branch( lambda value: value != 0 )
+
+        # Data pointer moves: '@' and '#' are interchangeable, ':' is relative and '*' reads the
+        # amount from the cell at the operand.
+        for base in (MODE_AT, MODE_LIT):
+            dispatch[OP_RIGHT][base] = self._set_dp
+            dispatch[OP_RIGHT][base + 1] = self._set_dp_abs
+            dispatch[OP_RIGHT][base + 2] = self._add_dp
+            dispatch[OP_RIGHT][base + 3] = self._add_dp_abs
+            dispatch[OP_LEFT][base] = self._set_dp
+            dispatch[OP_LEFT][base + 1] = self._set_dp_abs
+            dispatch[OP_LEFT][base + 2] = self._sub_dp
+            dispatch[OP_LEFT][base + 3] = self._sub_dp_abs
+
+        # '@' modes resolve a target cell, '#' modes resolve a source value
+        address = { MODE_AT:         lambda value: value,
+                    MODE_AT_ABS:     lambda value: self._data_array[value],
+                    MODE_AT_REL:     lambda value: self._data_pointer + value,
+                    MODE_AT_REL_ABS: lambda value: self._data_array[self._data_pointer + value] }
+        source = { MODE_LIT:         lambda value: value,
+                   MODE_LIT_ABS:     lambda value: self._data_array[value],
+                   MODE_LIT_REL:     lambda value: self._data_array[self._data_pointer + value],
+                   MODE_LIT_REL_ABS: lambda value: self._data_array[self._data_array[self._data_pointer + value]] }
+
+        for mode, resolve in address.items():
+            dispatch[OP_INC][mode] = self._make_store( resolve, lambda old, current: (old + 1) & mask )
+            dispatch[OP_DEC][mode] = self._make_store( resolve, lambda old, current: (old - 1) & mask )
+            dispatch[OP_OUTPUT][mode] = self._make_store( resolve, lambda old, current: current )
+            dispatch[OP_INPUT][mode] = self._make_store( resolve, lambda old, current: self._read_input() )
+            dispatch[OP_AND][mode] = self._make_store( resolve, lambda old, current: (old & current) & mask )
+            dispatch[OP_OR][mode] = self._make_store( resolve, lambda old, current: (old | current) & mask )
+            dispatch[OP_XOR][mode] = self._make_store( resolve, lambda old, current: (old ^ current) & mask )
+            dispatch[OP_RSHIFT][mode] = self._make_store( resolve, lambda old, current: (old >> current) & mask )
+            dispatch[OP_LSHIFT][mode] = self._make_store( resolve, lambda old, current: (old << current) & mask )
+            dispatch[OP_OPEN][mode] = self._make_branch( lambda value, resolve=resolve: self._data_array[resolve(value)] == 0 )
+            dispatch[OP_CLOSE][mode] = self._make_branch( lambda value, resolve=resolve: self._data_array[resolve(value)] != 0 )
+
+        for mode, resolve in source.items():
+            dispatch[OP_INC][mode] = self._make_update( resolve, lambda current, value: (current + value) & mask )
+            dispatch[OP_DEC][mode] = self._make_update( resolve, lambda current, value: (current - value) & mask )
+            dispatch[OP_OUTPUT][mode] = lambda value, resolve=resolve: self._put( resolve(value) )
+            dispatch[OP_INPUT][mode] = self._make_update( resolve, lambda current, value: value )
+            dispatch[OP_AND][mode] = self._make_update( resolve, lambda current, value: (current & value) & mask )
+            dispatch[OP_OR][mode] = self._make_update( resolve, lambda current, value: (current | value) & mask )
+            dispatch[OP_XOR][mode] = self._make_update( resolve, lambda current, value: (current ^ value) & mask )
+            dispatch[OP_RSHIFT][mode] = self._make_update( resolve, lambda current, value: (current >> value) & mask )
+            dispatch[OP_LSHIFT][mode] = self._make_update( resolve, lambda current, value: (current << value) & mask )
+            dispatch[OP_NOT][mode] = self._make_update( resolve, lambda current, value: (~value) & mask )
+            dispatch[OP_OPEN][mode] = self._make_branch( lambda value, resolve=resolve: self._data_array[self._data_pointer] == resolve(value) )
+            dispatch[OP_CLOSE][mode] = self._make_branch( lambda value, resolve=resolve: self._data_array[self._data_pointer] != resolve(value) )
+
+        return dispatch
+
+    def _make_store(self, resolve, operation):
+        # Handler writing operation(target cell, current cell) to the resolved target cell
+        def handler(value):
+            target = resolve( value )
+            self._data_array[target] = operation( self._data_array[target], self._data_array[self._data_pointer] )
+        return handler
+
+    def _make_update(self, resolve, operation):
+        # Handler writing operation(current cell, resolved value) to the current cell
+        def handler(value):
+            self._data_array[self._data_pointer] = operation( self._data_array[self._data_pointer], resolve(value) )
+        return handler
+
+    def _make_branch(self, condition):
+        # Handler jumping to the matching bracket when condition holds
+        def handler(value):
+            if condition( value ):
+                self._instruction_pointer = self._jump_table[self._instruction_pointer]
+        return handler
+
+    def _right(self, value):
+        # Move data pointer right one
+        self._data_pointer = (self._data_pointer + 1) % len(self._data_array)
+
+    def _right_checked(self, value):
+        self._right( value )
+        if self._data_pointer == 0:
+            print( "Overran data array!" )
+            empty = input( "Press enter to continue" )
+
+    def _left(self, value):
+        # Move data pointer left one
+        self._data_pointer = (self._data_pointer - 1) % len(self._data_array)
+
+    def _left_checked(self, value):
+        self._left( value )
+        if self._data_pointer == (len(self._data_array) - 1):
+            print( "Underran data array!" )
+            empty = input( "Press enter to continue" )
+
+    def _inc(self, value):
+        # Increment current data value
+        self._data_array[self._data_pointer] = (self._data_array[self._data_pointer] + 1) & self._cell_mask
+
+    def _dec(self, value):
+        # Decrement current data value
+        self._data_array[self._data_pointer] = (self._data_array[self._data_pointer] - 1) & self._cell_mask
+
+    def _output(self, value):
+        # Output the current data value to _stdout
+        self._put( self._data_array[self._data_pointer] )
+
+    def _input(self, value):
+        # Input a value from _stdin
+        self._data_array[self._data_pointer] = self._read_input()
+
+    def _open(self, value):
+        if self._data_array[self._data_pointer] == 0:
+            self._instruction_pointer = self._jump_table[self._instruction_pointer]
+
+    def _close(self, value):
+        if self._data_array[self._data_pointer] != 0:
+            self._instruction_pointer = self._jump_table[self._instruction_pointer]
+
+    def _not(self, value):
+        self._data_array[self._data_pointer] = (~self._data_array[self._data_pointer]) & self._cell_mask
+
+    def _swap_dp(self, value):
+        temp = self._data_pointer
+        self._data_pointer = self._shadow_data_pointer
+        self._shadow_data_pointer = temp
+
+    def _swap_ip(self, value):
+        temp = self._instruction_pointer
+        self._instruction_pointer = self._shadow_instruction_pointer
+        self._shadow_instruction_pointer = temp
+
+    def _add(self, count):
+        self._data_array[self._data_pointer] = (self._data_array[self._data_pointer] + count) & self._cell_mask
+
+    def _move(self, count):
+        self._data_pointer = (self._data_pointer + count) % len(self._data_array)
+
+    def _move_checked(self, count):
+        # Fused runs of '>' and '<' wrap around the data array like the single moves do
+        target = self._data_pointer + count
+        self._move( count )
+        if target >= len(self._data_array):
+            print( "Overran data array!" )
+            empty = input( "Press enter to continue" )
+        elif target < 0:
+            print( "Underran data array!" )
+            empty = input( "Press enter to continue" )
+
+    def _clear(self, value):
+        self._data_array[self._data_pointer] = 0
+
+    def _scan(self, stride):
+        # Move the data pointer by stride until it lands on a zero cell
+        if self._data_array[self._data_pointer] == 0:
+            return
+        found = find_zero( self._data_array, self._data_pointer, stride )
+        if found < 0:
+            raise RuntimeError( "Scan loop never finds a zero cell: {}".format(self._instruction_pointer) )
+        self._data_pointer = found
+
+    def _multiply(self, terms):
+        value = self._data_array[self._data_pointer]
+        if value == 0:
+            return
+        size = len(self._data_array)
+        for offset, factor in terms:
+            target = (self._data_pointer + offset) % size
+            self._data_array[target] = (self._data_array[target] + value * factor) & self._cell_mask
+        self._data_array[self._data_pointer] = 0
+        self._data_pointer %= size
+
+    def _set_dp(self, value):
+        self._data_pointer = value # todo: bounds check
+
+    def _set_dp_abs(self, value):
+        self._data_pointer = self._data_array[ value ]
+
+    def _add_dp(self, value):
+        self._data_pointer += value
+
+    def _add_dp_abs(self, value):
+        self._data_pointer += self._data_array[ value ]
+
+    def _sub_dp(self, value):
+        self._data_pointer -= value
+
+    def _sub_dp_abs(self, value):
+        self._data_pointer -= self._data_array[ value ]
+
+    def _add_dp_rel(self, value):
+        self._data_pointer += self._data_array[ self._data_pointer + value ]
+
+    def _sub_dp_rel(self, value):
+        self._data_pointer -= self._data_array[ self._data_pointer + value ]
+
+    def _nop(self, value):
+        pass
+
+    def _extern(self, name):
+        self.flush()
+        self._functions[ name ]( self )
+
+    def _jump(self, target):
+        # target is the index of the label, resolved at load time. Execution continues after the
+        # label once the instruction pointer is stepped.
+        if self._debug >= 2:
+            print( "Jumping from {} to {}.".format( self._instruction_pointer, target ) )
+        self._instruction_pointer = target
+
+    def _call(self, target):
+        self._shadow_instruction_pointer = self._instruction_pointer
+        self._jump( target )
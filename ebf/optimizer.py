@@ -0,0 +1,126 @@
+from frontend import c_int
+
+# Optimization levels:
+#   0 - Emit every instruction as written.
+#   1 - Fold runs of '+ - > <' into single adds and replace '[-]' / '[+]' with a clear.
+#   2 - Additionally replace multiply and copy loops with straight-line offset arithmetic.
+#   3 - As 2, and the compiler tracks constant data pointer moves at compile time, indexing cells
+#       from the data pointer instead of moving it (see compiler.TRACK_OFFSET_LEVEL).
+MAX_LEVEL = 3
+
+def optimize(instructions, level=1):
+    if level <= 0:
+        return list(instructions)
+
+    optimized = fold_runs(instructions)
+    optimized = replace_loops(optimized, multiply=(level >= 2))
+    return optimized
+
+def _amount(i):
+    # Signed constant a '+', '-', '>' or '<' instruction adds, or None if it is not constant
+    if i.op not in ('+', '-', '>', '<'):
+        return None
+    if i.mode == '' and i.operand == '':
+        amount = 1
+    elif i.mode == '#' and i.operand != '':
+        amount = c_int(i.operand)
+    else:
+        return None
+    if i.op in ('-', '<'):
+        amount = -amount
+    return amount
+
+def _is_cell(i):
+    return i.op in ('+', '-')
+
+def _plain(i, op):
+    return i.op == op and i.mode == '' and i.operand == '' and i.label == ''
+
+def _add(template, cell, amount):
+    # Build a single literal add for the folded amount
+    if cell:
+        op = '+' if amount > 0 else '-'
+    else:
+        op = '>' if amount > 0 else '<'
+    return template._replace(op=op, mode='#', operand=str(abs(amount)), label='')
+
+def fold_runs(instructions):
+    # Merge adjacent constant cell adds and adjacent constant pointer moves
+    folded = []
+    run = None
+    total = 0
+    for i in instructions:
+        amount = _amount(i)
+        if amount is not None and run is not None and _is_cell(run) == _is_cell(i):
+            total += amount
+            continue
+
+        if run is not None and total != 0:
+            folded.append(_add(run, _is_cell(run), total))
+        run = None
+
+        if amount is not None:
+            run = i
+            total = amount
+        else:
+            folded.append(i)
+
+    if run is not None and total != 0:
+        folded.append(_add(run, _is_cell(run), total))
+
+    return folded
+
+def _loop_deltas(body):
+    # Net change of each cell relative to the loop's cell, or None if the loop moves the pointer
+    offset = 0
+    deltas = {}
+    for i in body:
+        if _is_cell(i):
+            deltas[offset] = deltas.get(offset, 0) + _amount(i)
+        else:
+            offset += _amount(i)
+    if offset != 0:
+        return None
+    return dict((k, v) for k, v in deltas.items() if v != 0)
+
+def replace_loops(instructions, multiply=False):
+    # Replace innermost loops made only of constant adds and moves with straight-line code
+    replaced = []
+    index = 0
+    while index < len(instructions):
+        i = instructions[index]
+        if _plain(i, '['):
+            end = index + 1
+            while end < len(instructions) and _amount(instructions[end]) is not None:
+                end += 1
+            if end < len(instructions) and _plain(instructions[end], ']'):
+                replacement = _replace_loop(i, instructions[index+1:end], multiply)
+                if replacement is not None:
+                    replaced.extend(replacement)
+                    index = end + 1
+                    continue
+        replaced.append(i)
+        index += 1
+
+    return replaced
+
+def _replace_loop(start, body, multiply):
+    deltas = _loop_deltas(body)
+    if deltas is None or deltas.get(0) not in (-1, 1):
+        return None
+
+    clear = start._replace(op=',', mode='#', operand='0')
+    if len(deltas) == 1:
+        # '[-]' and '[+]' both run until the cell wraps to zero
+        return [clear]
+
+    if not multiply or deltas[0] != -1:
+        return None
+
+    # The loop runs *DP times, adding factor * *DP to every other touched cell
+    replacement = []
+    for offset in sorted(deltas):
+        if offset != 0:
+            replacement.append(start._replace(op='*', operand=(offset, deltas[offset])))
+    replacement.append(clear)
+    return replacement
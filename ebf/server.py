@@ -0,0 +1,106 @@
+import os
+import sys
+import json
+import socket
+import signal
+import socketserver
+import ebf
+import frontend
+
+# Each connection carries a single request: one JSON object on one line,
+#   { "builds": [ [infile, out_path], ... ], "options": { ... } }
+# where options are the optimization, always_make and instrument arguments of ebf.build(). The
+# server answers with one JSON object per line for each build,
+#   { "infile": ..., "built": true|false } or { "infile": ..., "error": ... },
+# and then closes the connection. Paths must be absolute, since the server has its own working
+# directory.
+
+def default_address():
+    return os.environ.get( "EBF_SERVER", os.path.join(frontend.default_cache_dir(), "server.sock") )
+
+class _Handler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        line = self.rfile.readline()
+        if not line:
+            # A connection checking whether the server is alive
+            return
+        try:
+            request = json.loads( line.decode("utf-8") )
+            builds = request["builds"]
+            options = dict( request.get("options", {}) )
+        except (ValueError, KeyError, TypeError) as e:
+            self._send( { "error": "Invalid request: {}".format(e) } )
+            return
+
+        # Parse results are cached under the server's own cache directory
+        options["cache_dir"] = self.server.cache_dir
+        for infile, out_path in builds:
+            try:
+                built = ebf.build( infile, out_path, recent=self.server.recent, **options )
+                self._send( { "infile": infile, "built": built } )
+            except Exception as e:
+                self._send( { "infile": infile, "error": str(e) } )
+
+    def _send(self, response):
+        self.wfile.write( (json.dumps(response) + "\n").encode("utf-8") )
+
+class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    # Compile server keeping the compiler modules, the templates and recent results in memory
+
+    daemon_threads = True
+
+    def __init__(self, address, cache_dir=None, recent_size=256):
+        self.cache_dir = cache_dir
+        self.recent = frontend.RecentCache( recent_size )
+        ebf.load_templates( ebf.template_module_dir(cache_dir) )
+        if os.path.exists(address):
+            # Only replace a stale socket, never a live server
+            try:
+                connect(address).close()
+            except (IOError, OSError):
+                os.remove(address)
+            else:
+                raise IOError("A server is already listening on {}".format(address))
+        directory = os.path.dirname(address)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        socketserver.UnixStreamServer.__init__(self, address, _Handler)
+
+    def server_close(self):
+        socketserver.UnixStreamServer.server_close(self)
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)
+
+def serve(address, cache_dir=None):
+    server = Server(address, cache_dir)
+    # Exit through the finally block on SIGTERM too, so the socket is removed
+    signal.signal( signal.SIGTERM, lambda signum, frame: sys.exit(0) )
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+def connect(address):
+    client = socket.socket( socket.AF_UNIX, socket.SOCK_STREAM )
+    try:
+        client.connect( address )
+    except:
+        client.close()
+        raise
+    return client
+
+def request(address, builds, options):
+    # Send builds to the server at address, yielding each response as it arrives. Raises
+    # IOError/OSError if no server is listening.
+    client = connect(address)
+    try:
+        builds = [ [os.path.abspath(infile), os.path.abspath(out_path)] for infile, out_path in builds ]
+        client.sendall( (json.dumps({ "builds": builds, "options": options }) + "\n").encode("utf-8") )
+        with client.makefile('rb') as f:
+            for line in f:
+                yield json.loads( line.decode("utf-8") )
+    finally:
+        client.close()
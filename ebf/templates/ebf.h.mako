@@ -26,5 +26,12 @@ else:
 typedef ${cell_type} cell_t;
 
 extern cell_t* DP;
+% if counter_count is not UNDEFINED and counter_count > 0:
+
+/* Block counters of an instrumented build, see ebf_counters.map */
+extern unsigned long ebf_counters[];
+extern const size_t ebf_counter_count;
+void ebf_dump_counters(void);
+% endif
 
 #endif /* EBF_H */
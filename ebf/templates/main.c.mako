@@ -15,18 +15,118 @@
 % endfor
 % endif
 
+<%
+output_buffer_size = 0
+if output_buffer is not UNDEFINED and output_buffer:
+    output_buffer_size = int(output_buffer)
+if output_flush_hook is not UNDEFINED and output_flush_hook == True and output_buffer_size == 0:
+    output_buffer_size = 1
+input_buffer_size = 0
+if input_buffer is not UNDEFINED and input_buffer:
+    input_buffer_size = int(input_buffer)
+if input_fill_hook is not UNDEFINED and input_fill_hook == True and input_buffer_size == 0:
+    input_buffer_size = 1
+input_eof_value = "EOF"
+if input_eof is not UNDEFINED and input_eof is not None:
+    input_eof_value = str(input_eof)
+%>\
 cell_t* DP;
+% if counter_count is not UNDEFINED and counter_count > 0:
+
+unsigned long ebf_counters[${counter_count}];
+const size_t ebf_counter_count = ${counter_count};
+
+void ebf_dump_counters(void) {
+    size_t i;
+    for (i = 0; i < ebf_counter_count; i++) {
+        fprintf(stderr, "%lu %lu\n", (unsigned long)i, ebf_counters[i]);
+    }
+}
+% endif
+% if output_buffer_size > 0:
+
+static unsigned char output_buffer[${output_buffer_size}];
+static size_t output_length = 0;
+
+static void ebf_flush(void) {
+    if (output_length > 0) {
+    % if output_flush_hook is not UNDEFINED and output_flush_hook == True:
+        output_flush_hook(output_buffer, output_length);
+    % else:
+        fwrite(output_buffer, 1, output_length, stdout);
+        fflush(stdout);
+    % endif
+        output_length = 0;
+    }
+}
+
+static void ebf_putchar(cell_t c) {
+    output_buffer[output_length++] = (unsigned char)c;
+    if (output_length == sizeof(output_buffer)) {
+        ebf_flush();
+    }
+}
+% endif
+% if input_buffer_size > 0:
+
+static unsigned char input_buffer[${input_buffer_size}];
+static size_t input_length = 0;
+static size_t input_position = 0;
+% endif
+% if output_buffer_size > 0 or input_buffer_size > 0 or input_eof_value != "EOF":
+
+static int ebf_getchar(void) {
+    % if input_buffer_size > 0:
+    if (input_position == input_length) {
+        % if output_buffer_size > 0:
+        /* Show any pending output before waiting for input */
+        ebf_flush();
+        % endif
+        % if input_fill_hook is not UNDEFINED and input_fill_hook == True:
+        input_length = input_fill_hook(input_buffer, sizeof(input_buffer));
+        % else:
+        input_length = fread(input_buffer, 1, sizeof(input_buffer), stdin);
+        % endif
+        input_position = 0;
+        if (input_length == 0) {
+            return ${input_eof_value};
+        }
+    }
+    return input_buffer[input_position++];
+    % else:
+    int c;
+        % if output_buffer_size > 0:
+    /* Show any pending output before waiting for input */
+    ebf_flush();
+        % endif
+    c = getchar();
+    return c == EOF ? ${input_eof_value} : c;
+    % endif
+}
+% endif
 
 int main(void) {
+    /* The application works on a local copy of DP, which is only written back to DP where user
+     * code can see it: around external function calls and for the cleanup hook. */
+    cell_t* dp;
+
     % if init_hook is not UNDEFINED and init_hook == True:
     init_hook();
 
     % endif
+    dp = DP;
     /* Start User Application ============================================ */
     % for line in application.splitlines(False):
     ${line}
     % endfor
     /* End User Application ============================================== */
+    DP = dp;
+    % if counter_count is not UNDEFINED and counter_count > 0:
+    ebf_dump_counters();
+    % endif
+    % if output_buffer_size > 0:
+    ebf_flush();
+    % endif
     % if cleanup_hook is not UNDEFINED and cleanup_hook == True:
 
     cleanup_hook();